@@ -0,0 +1,235 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Benchmark MPN against the fake MPD server in fakempd.py, over a synthetic music
+tree, with notifications going to an in-process sink instead of a notification
+daemon. Reports the latency from each song change to its notification, the CPU
+time used and the peak memory.
+
+Needs everything MPN itself needs, including a display if the status icon is
+enabled.
+"""
+
+import os
+import sys
+import time
+import shutil
+import optparse
+import resource
+import tempfile
+import threading
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(here))
+
+# synthetic music tree
+# ------------------------------------------------------------------------------
+
+def make_tree(root, options):
+	"""Create albums of empty audio files matching the fake server's queue,
+	each with a cover of random pixels, which compress badly and so make
+	large files"""
+	import Image
+	for album in range(options.albums):
+		path = os.path.join(root, "album%04d" % album)
+		os.makedirs(path)
+		for track in range(options.tracks_per_album):
+			open(os.path.join(path, "%02d.flac" % track), "w").close()
+		for i in range(options.extra_files):
+			open(os.path.join(path, "extra%05d.txt" % i), "w").close()
+		if album % 10 < options.cover_ratio * 10:
+			size = options.cover_size
+			image = Image.fromstring("RGB", (size, size),
+					os.urandom(size * size * 3))
+			image.save(os.path.join(path, "cover.jpg"), quality=90)
+
+def slow_filesystem(delay):
+	"""Make every stat and directory listing take delay seconds longer, as
+	they might on NFS"""
+	def slow(function):
+		def wrapper(*args, **kwargs):
+			time.sleep(delay)
+			return function(*args, **kwargs)
+		return wrapper
+	os.stat = slow(os.stat)
+	os.listdir = slow(os.listdir)
+
+# notification sink
+# ------------------------------------------------------------------------------
+
+class Sink:
+	"""Stands in for the notify2 module, recording when each notification is
+	shown and what its title was"""
+	EXPIRES_NEVER = 0
+	shown = []
+
+	def init(self, *args, **kwargs):
+		return True
+
+	class Notification:
+		summary = None
+
+		def __init__(self, summary, *args, **kwargs):
+			self.summary = summary
+
+		def update(self, summary, *args, **kwargs):
+			self.summary = summary
+
+		def show(self):
+			Sink.shown.append((time.time(), self.summary))
+			return True
+
+		def connect(self, *args, **kwargs):
+			pass
+
+		def close(self):
+			pass
+
+		def set_timeout(self, *args, **kwargs):
+			pass
+
+		def set_icon_from_pixbuf(self, *args, **kwargs):
+			pass
+
+		def add_action(self, *args, **kwargs):
+			pass
+
+# reporting
+# ------------------------------------------------------------------------------
+
+def percentile(values, fraction):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def report(changes, shown, usage):
+	"""Print latency percentiles from the song changes to the notifications
+	for them, and the resources used"""
+	latencies = []
+	missed = 0
+	for songid, changed in changes:
+		times = [t for t, summary in shown
+				if summary == "song %d" % songid and t >= changed]
+		if times:
+			latencies.append(times[0] - changed)
+		else:
+			missed += 1
+	print "song changes:     %d" % len(changes)
+	print "notifications:    %d (%d changes never shown)" \
+			% (len(shown), missed)
+	if latencies:
+		for name, fraction in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99),
+				("max", 1)):
+			print "latency %s:      %.1fms" \
+					% (name, percentile(latencies, fraction) * 1000)
+	print "cpu time:         %.2fs user, %.2fs system" \
+			% (usage.ru_utime, usage.ru_stime)
+	print "peak memory:      %.1fMB" % (usage.ru_maxrss / 1024.0)
+
+# main
+# ------------------------------------------------------------------------------
+
+def main():
+	parser = optparse.OptionParser(description="Benchmark MPN against a fake "
+			"MPD server")
+	parser.add_option("--changes", type="int", default=50,
+			help="Number of song changes (default %default)")
+	parser.add_option("--interval", type="float", default=500, metavar="MS",
+			help="Time between song changes (default %default)")
+	parser.add_option("--latency", type="float", default=0, metavar="MS",
+			help="Delay the server adds to each command (default %default)")
+	parser.add_option("--tag-size", type="int", default=0, metavar="BYTES",
+			help="Size of an extra tag sent with every song (default "
+					"%default)")
+	parser.add_option("--albums", type="int", default=20,
+			help="Number of albums in the music tree (default %default)")
+	parser.add_option("--tracks-per-album", type="int", default=3,
+			help="Number of tracks in each album (default %default)")
+	parser.add_option("--extra-files", type="int", default=0,
+			help="Number of other files in each album directory, to make them "
+					"large (default %default)")
+	parser.add_option("--cover-size", type="int", default=1000, metavar="PX",
+			help="Width and height of the covers (default %default)")
+	parser.add_option("--cover-ratio", type="float", default=0.8,
+			help="Fraction of albums having a cover (default %default)")
+	parser.add_option("--slow-stat", type="float", default=0, metavar="MS",
+			help="Delay added to every stat and directory listing (default "
+					"%default)")
+	parser.add_option("--status-icon", action="store_true",
+			help="Show the status icon too (needs a display)")
+	parser.add_option("--option", action="append", default=[],
+			metavar="NAME=YAML", help="Set any other MPN option, for instance "
+					"--option image_threads=0; may be repeated")
+	parser.add_option("--keep", action="store_true",
+			help="Keep the temporary music tree and cache afterwards")
+	options, args = parser.parse_args()
+
+	workspace = tempfile.mkdtemp(prefix="mpn-bench-")
+	try:
+		music = os.path.join(workspace, "music")
+		os.makedirs(music)
+		make_tree(music, options)
+		os.environ["XDG_CACHE_HOME"] = os.path.join(workspace, "cache")
+		os.environ["XDG_RUNTIME_DIR"] = workspace
+		run(music, options)
+	finally:
+		if options.keep:
+			print "kept %s" % workspace
+		else:
+			shutil.rmtree(workspace)
+
+def run(music, options):
+	import yaml
+	import mpn
+	mpn.notify2 = Sink()
+
+	server = subprocess.Popen([sys.executable,
+			os.path.join(here, "fakempd.py"),
+			"--changes", str(options.changes),
+			"--interval", str(options.interval),
+			"--latency", str(options.latency),
+			"--tag-size", str(options.tag_size),
+			"--albums", str(options.albums),
+			"--tracks-per-album", str(options.tracks_per_album)],
+			stdout=subprocess.PIPE)
+	port = int(server.stdout.readline().split()[1])
+	changes = []
+	def read_changes():
+		for line in server.stdout:
+			word, songid, changed = line.split()
+			changes.append((int(songid), float(changed)))
+		mpn.glib.idle_add(mpn.gtk.main_quit)
+	reader = threading.Thread(target=read_changes)
+	reader.daemon = True
+	reader.start()
+
+	values = dict(mpn.DEFAULT_OPTIONS)
+	values.update(music_path=music, status_icon=bool(options.status_icon),
+			persist=False, title_format="%t", timeout=0)
+	for option in options.option:
+		name, value = option.split("=", 1)
+		values[name] = yaml.safe_load(value)
+	mpn_options = optparse.Values(values)
+
+	if options.slow_stat:
+		slow_filesystem(options.slow_stat / 1000.0)
+
+	resources = mpn.Resources(mpn_options)
+	notifier = mpn.Notifier(mpn_options, resources,
+			{"name": "bench", "host": "127.0.0.1", "port": port})
+	mpn.gtk.gdk.threads_init()
+	if not notifier.connect():
+		print "Failed to connect to the fake server"
+		server.kill()
+		sys.exit(1)
+	if resources.cover_index is not None:
+		resources.cover_index.rescan()
+	mpn.gtk.main()
+
+	notifier.shutdown()
+	server.wait()
+	report(changes, Sink.shown, resource.getrusage(resource.RUSAGE_SELF))
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,225 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+A scripted stand-in for MPD, for benchmarking MPN. It speaks enough of the MPD
+protocol for MPN (status, currentsong, playlistid, command lists and idle) and
+plays through a queue of synthetic songs, changing song at a fixed rate.
+
+The first line written to standard output is "port N", the port listened on;
+after that a line "changed SONGID TIME" is written each time the song changes,
+TIME being when idle clients were told.
+"""
+
+import sys
+import time
+import socket
+import threading
+import optparse
+
+class FakeMPD:
+	"""The state of the fake server and its clients"""
+	options = None
+	lock = None
+	songs = None
+	position = 0
+	playlist_version = 1
+	idlers = None
+
+	def __init__(self, options):
+		self.options = options
+		self.lock = threading.Lock()
+		self.idlers = {}
+		padding = "x" * options.tag_size
+		self.songs = []
+		for i in range(options.queue_length):
+			album = i // options.tracks_per_album % options.albums
+			self.songs.append([
+				("file", "album%04d/%02d.flac"
+						% (album, i % options.tracks_per_album)),
+				("Title", "song %d" % i),
+				("Artist", "Artist %d" % (album % 17)),
+				("Album", "Album %d" % album),
+				("Track", str(i % options.tracks_per_album + 1)),
+				("Comment", padding),
+				("Time", "200"),
+				("duration", "200.000"),
+				("Pos", str(i)),
+				("Id", str(i)),
+				])
+
+	def status(self):
+		song = self.songs[self.position]
+		nextpos = (self.position + 1) % len(self.songs)
+		return [
+			("volume", "100"),
+			("repeat", "0"),
+			("random", "0"),
+			("single", "0"),
+			("consume", "0"),
+			("playlist", str(self.playlist_version)),
+			("playlistlength", str(len(self.songs))),
+			("state", "play"),
+			("song", str(self.position)),
+			("songid", dict(song)["Id"]),
+			("nextsong", str(nextpos)),
+			("nextsongid", str(nextpos)),
+			("time", "1:200"),
+			("elapsed", "1.000"),
+			("duration", "200.000"),
+			("bitrate", "900"),
+			("audio", "44100:16:2"),
+			]
+
+	def advance(self):
+		"""Move on to the next song and wake clients idling on the player"""
+		with self.lock:
+			self.position = (self.position + 1) % len(self.songs)
+			songid = self.position
+			woken = [connection for connection, subsystems
+					in self.idlers.items()
+					if not subsystems or "player" in subsystems]
+			for connection in woken:
+				del self.idlers[connection]
+			now = time.time()
+			for connection in woken:
+				self.send(connection, "changed: player\nOK\n")
+		sys.stdout.write("changed %d %.6f\n" % (songid, now))
+		sys.stdout.flush()
+
+	def send(self, connection, text):
+		try:
+			connection.sendall(text)
+		except socket.error:
+			pass
+
+	def respond(self, command, args):
+		"""Return the lines answering a command, or raise KeyError if it's
+		unknown"""
+		if command == "status":
+			return self.status()
+		if command == "currentsong":
+			return self.songs[self.position]
+		if command == "playlistid":
+			return self.songs[int(args[0].strip('"'))]
+		if command in ("ping", "password", "play", "pause", "stop",
+				"clearerror"):
+			return []
+		if command == "next":
+			threading.Thread(target=self.advance).start()
+			return []
+		raise KeyError(command)
+
+	def serve(self, connection):
+		connection.sendall("OK MPD 0.19.0\n")
+		lines = connection.makefile("r")
+		command_list = None
+		while True:
+			line = lines.readline()
+			if not line:
+				break
+			words = line.split()
+			if not words:
+				continue
+			command, args = words[0], words[1:]
+			if command == "close":
+				break
+			if command == "idle":
+				with self.lock:
+					self.idlers[connection] = set(args)
+				continue
+			if command == "noidle":
+				with self.lock:
+					if self.idlers.pop(connection, None) is not None:
+						self.send(connection, "OK\n")
+				continue
+			if command in ("command_list_begin", "command_list_ok_begin"):
+				command_list = (command, [])
+				continue
+			if command_list is not None and command != "command_list_end":
+				command_list[1].append((command, args))
+				continue
+
+			time.sleep(self.options.latency / 1000.0)
+			if command == "command_list_end":
+				kind, commands = command_list
+				command_list = None
+				reply = []
+				for command, args in commands:
+					with self.lock:
+						pairs = self.respond(command, args)
+					reply.extend("%s: %s\n" % pair for pair in pairs)
+					if kind == "command_list_ok_begin":
+						reply.append("list_OK\n")
+				self.send(connection, "".join(reply) + "OK\n")
+				continue
+			try:
+				with self.lock:
+					pairs = self.respond(command, args)
+			except KeyError:
+				self.send(connection, "ACK [5@0] {%s} unknown command \"%s\"\n"
+						% (command, command))
+				continue
+			self.send(connection, "".join("%s: %s\n" % pair for pair in pairs)
+					+ "OK\n")
+		with self.lock:
+			self.idlers.pop(connection, None)
+		connection.close()
+
+	def run(self, port):
+		listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+		listener.bind(("127.0.0.1", port))
+		listener.listen(5)
+		sys.stdout.write("port %d\n" % listener.getsockname()[1])
+		sys.stdout.flush()
+
+		def accept():
+			while True:
+				connection, address = listener.accept()
+				connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+				thread = threading.Thread(target=self.serve,
+						args=(connection,))
+				thread.daemon = True
+				thread.start()
+		thread = threading.Thread(target=accept)
+		thread.daemon = True
+		thread.start()
+
+		time.sleep(self.options.warmup)
+		for i in range(self.options.changes):
+			self.advance()
+			time.sleep(self.options.interval / 1000.0)
+		# let the last notification through before going away
+		time.sleep(1)
+
+def main():
+	parser = optparse.OptionParser(description="Pretend to be an MPD server "
+			"playing through a queue of synthetic songs")
+	parser.add_option("--port", type="int", default=0,
+			help="Port to listen on (default any free port)")
+	parser.add_option("--latency", type="float", default=0, metavar="MS",
+			help="Delay before answering each command (default %default)")
+	parser.add_option("--interval", type="float", default=500, metavar="MS",
+			help="Time between song changes (default %default)")
+	parser.add_option("--changes", type="int", default=50,
+			help="Number of song changes before exiting (default %default)")
+	parser.add_option("--warmup", type="float", default=2, metavar="SECS",
+			help="Time to wait for clients before the first change (default "
+					"%default)")
+	parser.add_option("--queue-length", type="int", default=1000,
+			help="Number of songs in the queue (default %default)")
+	parser.add_option("--albums", type="int", default=100,
+			help="Number of albums the songs are spread over (default "
+					"%default)")
+	parser.add_option("--tracks-per-album", type="int", default=10,
+			help="Number of consecutive songs in each album (default "
+					"%default)")
+	parser.add_option("--tag-size", type="int", default=0, metavar="BYTES",
+			help="Size of an extra tag sent with every song (default "
+					"%default)")
+	options, args = parser.parse_args()
+	FakeMPD(options).run(options.port)
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,90 @@
+#! /usr/bin/python
+# -*- coding: utf-8 -*-
+
+"""
+Time how long MPN takes to start for invocations which shouldn't need its heavy
+dependencies, and check that they aren't imported. Exits with status 1 if any
+of them were, or if MPN crashed.
+"""
+
+import os
+import sys
+import time
+import optparse
+import subprocess
+
+here = os.path.dirname(os.path.abspath(__file__))
+
+# modules which only some code paths need
+HEAVY = ("gtk", "glib", "gobject", "mpd", "notify2", "Image", "dbus")
+
+# argument lists to time, None meaning just importing mpn
+INVOCATIONS = (
+	None,
+	["--version"],
+	["--help"],
+	["--show-defaults"],
+	["--stats"],
+	["ctl", "help"],
+	)
+
+PROGRAM = """
+import sys
+sys.path.insert(0, %r)
+import mpn
+if %r is not None:
+	sys.argv = ["mpn"] + %r
+	try:
+		mpn.Application().run()
+	except SystemExit:
+		pass
+sys.stderr.write("imported: "
+		+ ",".join(name for name in %r if name in sys.modules) + "\\n")
+"""
+
+def run(arguments):
+	"""Run MPN once with the given arguments, return the time taken and the
+	heavy modules imported, or None for those if it crashed"""
+	program = PROGRAM % (os.path.dirname(here), arguments, arguments, HEAVY)
+	start = time.time()
+	process = subprocess.Popen([sys.executable, "-c", program],
+			stdout=open(os.devnull, "w"), stderr=subprocess.PIPE)
+	errors = process.communicate()[1]
+	elapsed = time.time() - start
+	for line in errors.splitlines():
+		if line.startswith("imported: "):
+			return elapsed, [name for name in line[10:].split(",") if name]
+	sys.stderr.write(errors)
+	return elapsed, None
+
+def main():
+	parser = optparse.OptionParser(description="Time MPN's startup")
+	parser.add_option("--runs", type="int", default=10,
+			help="Number of times to run each invocation (default %default)")
+	options, args = parser.parse_args()
+
+	failed = False
+	for arguments in INVOCATIONS:
+		times = []
+		imported = set()
+		crashed = False
+		for i in range(options.runs):
+			elapsed, heavy = run(arguments)
+			times.append(elapsed)
+			if heavy is None:
+				crashed = True
+			else:
+				imported.update(heavy)
+		times.sort()
+		name = "import mpn" if arguments is None \
+				else "mpn " + " ".join(arguments)
+		print "%-20s min %6.1fms  median %6.1fms%s" % (name,
+				times[0] * 1000, times[len(times) // 2] * 1000,
+				"  imported " + ", ".join(sorted(imported)) if imported else "")
+		if crashed:
+			print "%-20s crashed" % name
+		failed = failed or bool(imported) or crashed
+	sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+	main()
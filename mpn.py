@@ -45,15 +45,51 @@ import time
 import optparse
 import re
 import socket
+import select
 import signal
 import threading
-
-import gtk, glib, gobject
-import mpd
-import notify2
-import yaml
-import Image
-import numpy
+import struct
+import ctypes
+import ctypes.util
+import errno
+import collections
+import json
+import random
+import copy
+import itertools
+import Queue
+import StringIO
+import traceback
+import hashlib
+import contextlib
+import sqlite3
+import mmap
+import fcntl
+
+import mpnctl
+from mpnctl import control_socket_path, control_request
+
+class LazyModule:
+	"""Stands in for a module which is slow to import, importing it the first 
+	time one of its attributes is used, after which the module replaces this 
+	in the globals"""
+	def __init__(self, name):
+		self.__dict__["module_name"] = name
+
+	def __getattr__(self, attribute):
+		module = __import__(self.module_name)
+		globals()[self.module_name] = module
+		return getattr(module, attribute)
+
+# these take hundreds of milliseconds between them and many invocations 
+# (--help, --stats, --once with no cover art) need few or none of them
+gtk = LazyModule("gtk")
+glib = LazyModule("glib")
+gobject = LazyModule("gobject")
+mpd = LazyModule("mpd")
+notify2 = LazyModule("notify2")
+yaml = LazyModule("yaml")
+Image = LazyModule("Image")
 
 # utility
 # ------------------------------------------------------------------------------
@@ -74,21 +110,30 @@ def convert_time(raw):
 			hour = hour[1:]
 		return hour + ":" + minutes + ":" + sec
 
-def fileexists_insensitive(path):
-	"""check if a file exists, case-insensitively for the last component 
-	(basename)"""
-	searchdir = os.path.dirname(path)
-	searchfile = os.path.basename(path).lower()
-	if not os.path.exists(searchdir):
-		return False
-	files = os.listdir(searchdir)
-	for file in files:
-		if file.lower() == searchfile:
-			return os.path.join(searchdir, file)
-	return False
+class _timespec(ctypes.Structure):
+	_fields_ = [("tv_sec", ctypes.c_long), ("tv_nsec", ctypes.c_long)]
+
+def _clock_gettime():
+	"""Return libc's clock_gettime, or None if it isn't available"""
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+		return libc.clock_gettime
+	except (OSError, AttributeError, TypeError):
+		return None
+_clock_gettime = _clock_gettime()
+
+def monotonic():
+	"""Return seconds from a clock which doesn't jump when the system time is 
+	changed, falling back to the system time if there isn't one"""
+	if _clock_gettime is not None:
+		t = _timespec()
+		if _clock_gettime(1, ctypes.byref(t)) == 0: # CLOCK_MONOTONIC
+			return t.tv_sec + t.tv_nsec * 1e-9
+	return time.time()
 
 def possible_cover_filenames():
-	"""Generate a whole bunch of possible filenames for cover art"""
+	"""Generate a whole bunch of possible filenames for cover art, used as the 
+	default cover name rules"""
 	PREFIXES = [
 		"",
 		".",
@@ -107,12 +152,1356 @@ def possible_cover_filenames():
 		".png",
 		".jpg",
 	]
-	filenames = []
 	for pre in PREFIXES:
 		for mid in MIDDLES:
 			for suf in SUFFIXES:
 				yield pre + mid + suf
 
+def glob_to_regex(pattern):
+	"""Translate a shell-style glob (*, ? and [...] classes) to an unanchored 
+	regular expression"""
+	i, n = 0, len(pattern)
+	res = []
+	while i < n:
+		c = pattern[i]
+		i += 1
+		if c == "*":
+			res.append(".*")
+		elif c == "?":
+			res.append(".")
+		elif c == "[":
+			j = i
+			if j < n and pattern[j] == "!":
+				j += 1
+			if j < n and pattern[j] == "]":
+				j += 1
+			while j < n and pattern[j] != "]":
+				j += 1
+			if j >= n:
+				res.append("\\[")
+			else:
+				stuff = pattern[i:j].replace("\\", "\\\\")
+				i = j + 1
+				if stuff[0] == "!":
+					stuff = "^" + stuff[1:]
+				elif stuff[0] == "^":
+					stuff = "\\" + stuff
+				res.append("[%s]" % stuff)
+		else:
+			res.append(re.escape(c))
+	return "".join(res)
+
+# directory listings
+# ------------------------------------------------------------------------------
+
+class Inotify:
+	"""Minimal ctypes binding to Linux's inotify, used to find out when 
+	directories we have listed change"""
+	IN_ATTRIB = 0x00000004
+	IN_MOVED_FROM = 0x00000040
+	IN_MOVED_TO = 0x00000080
+	IN_CREATE = 0x00000100
+	IN_DELETE = 0x00000200
+	IN_DELETE_SELF = 0x00000400
+	IN_MOVE_SELF = 0x00000800
+	IN_Q_OVERFLOW = 0x00004000
+	IN_IGNORED = 0x00008000
+	IN_ONLYDIR = 0x01000000
+	IN_NONBLOCK = 0x00000800
+	IN_CLOEXEC = 0x00080000
+
+	# anything which can change the set of names in a directory
+	DIRECTORY_MASK = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE \
+			| IN_DELETE_SELF | IN_MOVE_SELF | IN_ATTRIB | IN_ONLYDIR
+
+	EVENT_HEADER = struct.Struct("iIII")
+
+	fd = None
+	libc = None
+
+	def __init__(self):
+		"""Raise OSError if inotify isn't available"""
+		libname = ctypes.util.find_library("c")
+		if libname is None:
+			raise OSError(errno.ENOSYS, "libc not found")
+		self.libc = ctypes.CDLL(libname, use_errno=True)
+		if not hasattr(self.libc, "inotify_init1"):
+			raise OSError(errno.ENOSYS, "inotify not available")
+		self.fd = self.libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+		if self.fd < 0:
+			e = ctypes.get_errno()
+			raise OSError(e, os.strerror(e))
+
+	def add_watch(self, path):
+		"""Watch a directory, return the watch descriptor or None on failure"""
+		if isinstance(path, unicode):
+			path = path.encode(sys.getfilesystemencoding())
+		wd = self.libc.inotify_add_watch(self.fd, path, self.DIRECTORY_MASK)
+		if wd < 0:
+			return None
+		return wd
+
+	def rm_watch(self, wd):
+		self.libc.inotify_rm_watch(self.fd, wd)
+
+	def read_events(self):
+		"""Read pending events, return a list of (wd, mask) tuples"""
+		events = []
+		while True:
+			try:
+				data = os.read(self.fd, 65536)
+			except OSError, e:
+				if e.errno in (errno.EAGAIN, errno.EINTR):
+					break
+				raise
+			if not data:
+				break
+			offset = 0
+			while offset < len(data):
+				wd, mask, cookie, length = \
+						self.EVENT_HEADER.unpack_from(data, offset)
+				events.append((wd, mask))
+				offset += self.EVENT_HEADER.size + length
+		return events
+
+class DirectoryCache:
+	"""Cache of directory listings, each stored as a dictionary mapping 
+	lowercased filenames to the real filenames.
+
+	With inotify each cached directory is watched and its listing dropped as 
+	soon as it changes, so a directory is listed at most once until it really 
+	does change. Without inotify (or when not running a main loop) the 
+	directory's mtime is checked instead, which costs a stat rather than a 
+	listing."""
+	max_entries = 1024
+	listings = None
+	watches = None
+	inotify = None
+	lock = None
+
+	def __init__(self, watch=True):
+		self.listings = collections.OrderedDict()
+		self.watches = {}
+		self.lock = threading.RLock()
+		if watch:
+			try:
+				self.inotify = Inotify()
+			except OSError:
+				self.inotify = None
+			else:
+				gobject.io_add_watch(self.inotify.fd, gobject.IO_IN,
+						self.on_inotify)
+
+	def listing(self, path):
+		"""Return the listing dictionary for a directory, or None if it 
+		can't be listed. The filesystem is only touched outside the lock, 
+		which on_inotify takes in the main loop, so a hung mount holds up 
+		only the thread asking."""
+		with self.lock:
+			entry = self.listings.get(path)
+		if entry is not None:
+			wd, mtime, listing = entry
+			if wd is not None or mtime == self._mtime(path):
+				with self.lock:
+					if self.listings.get(path) is entry:
+						# move to the end so it's evicted last
+						del self.listings[path]
+						self.listings[path] = entry
+				return listing
+			with self.lock:
+				if self.listings.get(path) is entry:
+					self._forget(path)
+
+		wd = None
+		if self.inotify is not None:
+			# watch before listing so no change can be missed
+			wd = self.inotify.add_watch(path)
+			if wd is not None:
+				with self.lock:
+					self.watches[wd] = path
+		mtime = None if wd is not None else self._mtime(path)
+		try:
+			names = os.listdir(path)
+		except OSError:
+			names = None
+
+		with self.lock:
+			if wd is not None and self.watches.get(wd) != path:
+				# changed while being listed, and on_inotify has already 
+				# dropped the watch; don't cache what may be stale
+				if names is None:
+					return None
+				return dict((name.lower(), name) for name in names)
+			if names is None:
+				if wd is not None and path not in self.listings:
+					del self.watches[wd]
+					self.inotify.rm_watch(wd)
+				return None
+			listing = dict((name.lower(), name) for name in names)
+			self.listings[path] = (wd, mtime, listing)
+
+			while len(self.listings) > self.max_entries:
+				self._forget(next(iter(self.listings)))
+			return listing
+
+	def invalidate(self, path=None):
+		"""Forget the listing of a directory, or all listings"""
+		with self.lock:
+			if path is None:
+				for p in self.listings.keys():
+					self._forget(p)
+			elif path in self.listings:
+				self._forget(path)
+
+	def _forget(self, path):
+		wd, mtime, listing = self.listings.pop(path)
+		if wd is not None and self.watches.pop(wd, None) is not None:
+			self.inotify.rm_watch(wd)
+
+	def _mtime(self, path):
+		try:
+			return os.stat(path).st_mtime
+		except OSError:
+			return None
+
+	def on_inotify(self, *args, **kwargs):
+		with self.lock:
+			for wd, mask in self.inotify.read_events():
+				if mask & Inotify.IN_Q_OVERFLOW:
+					# events were lost; trust nothing
+					self.invalidate()
+					continue
+				path = self.watches.pop(wd, None)
+				if path is None:
+					continue
+				self.listings.pop(path, None)
+				if not mask & Inotify.IN_IGNORED:
+					self.inotify.rm_watch(wd)
+		return True
+
+# cover art
+# ------------------------------------------------------------------------------
+
+class CoverMatcher:
+	"""Pick the best cover art file from a directory listing.
+
+	Rules are given as a list, each entry either a glob string or a mapping 
+	with a "glob" or "regex" key and optionally a "priority". Matching is 
+	case-insensitive and against the whole filename. Lower priorities win; a 
+	rule's priority defaults to its position in the list. All rules are 
+	compiled into a single regular expression so a listing is scanned in one 
+	pass, whatever the number of rules."""
+	rules = None
+	regex = None
+	priorities = None
+
+	def __init__(self, rules):
+		"""Raise ValueError if the rules are malformed"""
+		if not rules:
+			raise ValueError("no cover name rules given")
+		self.rules = rules
+		compiled = []
+		for i, rule in enumerate(rules):
+			priority = i
+			if isinstance(rule, basestring):
+				pattern = glob_to_regex(rule)
+			elif isinstance(rule, dict):
+				priority = rule.get("priority", i)
+				if "glob" in rule:
+					pattern = glob_to_regex(rule["glob"])
+				elif "regex" in rule:
+					pattern = rule["regex"]
+				else:
+					raise ValueError("cover name rule %r has neither a glob "
+							"nor a regex" % rule)
+				if not isinstance(priority, (int, long, float)):
+					raise ValueError("cover name rule %r has a non-numeric "
+							"priority" % rule)
+			else:
+				raise ValueError("cover name rule %r is neither a string nor "
+						"a mapping" % rule)
+			compiled.append((priority, i, pattern))
+
+		# alternatives are tried in order, so putting the most favoured first 
+		# means a name matching several rules reports the best of them
+		compiled.sort()
+		self.priorities = {}
+		alternatives = []
+		for priority, i, pattern in compiled:
+			group = "r%d" % i
+			self.priorities[group] = priority
+			alternatives.append("(?P<%s>%s)" % (group, pattern))
+		try:
+			self.regex = re.compile("(?:%s)\\Z" % "|".join(alternatives),
+					re.I | re.S)
+		except (re.error, AssertionError), e:
+			raise ValueError("bad cover name rules: %s" % e)
+
+	def match(self, names):
+		"""Return the best matching name out of those given, or None"""
+		best = None
+		best_priority = None
+		for name in names:
+			m = self.regex.match(name)
+			if m is None:
+				continue
+			priority = self.priorities[m.lastgroup]
+			if best is None or priority < best_priority \
+					or priority == best_priority and name < best:
+				best = name
+				best_priority = priority
+		return best
+
+	def find(self, dirname, dircache, depth=0, root=None):
+		"""Look for cover art in a directory and then up to depth of its 
+		parents, not going above root. Return the full path or None."""
+		dirname = os.path.normpath(dirname)
+		if root is not None:
+			root = os.path.normpath(root)
+		for level in range(depth + 1):
+			listing = dircache.listing(dirname)
+			if listing is not None:
+				name = self.match(listing.itervalues())
+				if name is not None:
+					return os.path.join(dirname, name)
+			if dirname == root:
+				break
+			parent = os.path.dirname(dirname)
+			if parent == dirname or root is not None \
+					and not parent.startswith(root):
+				break
+			dirname = parent
+		return None
+
+class MountUnresponsive(Exception):
+	"""Raised by MountGuard.call when a lookup took too long, or an earlier 
+	one still hasn't finished"""
+
+def read_file(path):
+	"""Return the contents of a file"""
+	with open(path, "rb") as f:
+		return f.read()
+
+class MountGuard:
+	"""Runs filesystem lookups under the music path, which may be on a network 
+	filesystem, in a long-lived thread of their own and waits for them only 
+	until a deadline. A lookup which misses its deadline is left to finish in 
+	that thread, and until it does the mount is taken to be unresponsive and 
+	further lookups fail straight away rather than piling up behind it.
+
+	Each lookup signals its completion through a pipe, waited on with select, 
+	since Python 2's timed waits on locks and events poll with sleeps of up to 
+	50ms."""
+	deadline = None
+	lock = None
+	queue = None
+	stuck = 0
+
+	def __init__(self, deadline):
+		"""deadline is in seconds"""
+		self.deadline = deadline
+		self.lock = threading.Lock()
+		self.queue = Queue.Queue()
+		thread = threading.Thread(target=self._run, name="lookup")
+		thread.daemon = True
+		thread.start()
+
+	def call(self, function, *args):
+		"""Return function(*args), or raise MountUnresponsive"""
+		if self.stuck:
+			raise MountUnresponsive("an earlier lookup is still waiting")
+		outcome = []
+		late = []
+		read, write = os.pipe()
+		self.queue.put((function, args, outcome, late, read, write))
+		end = monotonic() + self.deadline
+		while True:
+			try:
+				select.select([read], [], [], max(0, end - monotonic()))
+				break
+			except select.error, e:
+				if e.args[0] != errno.EINTR:
+					raise
+		with self.lock:
+			if not outcome:
+				# the lookup thread closes the pipe when it's done
+				late.append(True)
+				self.stuck += 1
+				if self.stuck == 1:
+					print "Music path took over %gs to respond; not looking " \
+							"there until it does" % self.deadline
+				raise MountUnresponsive("lookup took over %gs" % self.deadline)
+		os.close(read)
+		result, error = outcome[0]
+		if error is not None:
+			raise error[0], error[1], error[2]
+		return result
+
+	def _run(self):
+		while True:
+			function, args, outcome, late, read, write = self.queue.get()
+			try:
+				result = (function(*args), None)
+			except Exception:
+				result = (None, sys.exc_info())
+			with self.lock:
+				outcome.append(result)
+				if late:
+					self.stuck -= 1
+					if not self.stuck:
+						print "Music path is responding again"
+					os.close(read)
+				else:
+					os.write(write, "\0")
+			os.close(write)
+
+class NegativeCache:
+	"""Keys remembered for ttl seconds, for things looked for and not found 
+	which aren't worth looking for again straight away"""
+	# expired keys are only swept out once there are this many
+	SWEEP_SIZE = 1024
+	ttl = None
+	expiry = None
+	lock = None
+
+	def __init__(self, ttl):
+		self.ttl = ttl
+		self.expiry = {}
+		self.lock = threading.Lock()
+
+	def __contains__(self, key):
+		with self.lock:
+			expiry = self.expiry.get(key)
+			if expiry is None:
+				return False
+			if expiry < monotonic():
+				del self.expiry[key]
+				return False
+			return True
+
+	def add(self, key):
+		with self.lock:
+			now = monotonic()
+			if len(self.expiry) >= self.SWEEP_SIZE:
+				for old in [k for k, v in self.expiry.iteritems() if v < now]:
+					del self.expiry[old]
+			self.expiry[key] = now + self.ttl
+
+	def clear(self):
+		with self.lock:
+			self.expiry.clear()
+
+def cache_directory(*subdirectories):
+	"""Return MPN's cache directory, or the given subdirectory of it, creating 
+	it if necessary"""
+	path = os.path.join(os.environ.get("XDG_CACHE_HOME",
+			os.path.expanduser("~/.cache")), "mpn", *subdirectories)
+	if not os.path.isdir(path):
+		os.makedirs(path)
+	return path
+
+class CoverIndex:
+	"""Persistent index of the cover art chosen for each directory under the 
+	music path, kept in an SQLite database.
+
+	The index is built by a scan in a background thread, and rescanned on 
+	request (when MPD reports its database has changed). As well as the 
+	chosen cover and its mtime each directory's own mtime, subdirectories and 
+	best cover name are recorded, so a rescan only lists directories which 
+	have changed and otherwise costs a stat per directory."""
+	SCHEMA_VERSION = 1
+	db = None
+	lock = None
+	music_path = None
+	matcher = None
+	depth = None
+	on_change = None
+	pending = None
+	thread = None
+
+	def __init__(self, path, music_path, matcher, depth, on_change=None):
+		"""Open (or create) the index at the given path. If the music path or 
+		cover rules differ from those the index was built with it is emptied. 
+		on_change is called in the main loop after a scan which changed any 
+		directory's cover."""
+		self.music_path = os.path.normpath(music_path)
+		self.matcher = matcher
+		self.depth = depth
+		self.on_change = on_change
+		self.lock = threading.Lock()
+		self.pending = threading.Event()
+
+		self.db = sqlite3.connect(path, check_same_thread=False)
+		self.db.text_factory = str
+		with self.lock:
+			self.db.execute("CREATE TABLE IF NOT EXISTS meta ("
+					"key TEXT PRIMARY KEY, value TEXT)")
+			self.db.execute("CREATE TABLE IF NOT EXISTS covers ("
+					"directory TEXT PRIMARY KEY, mtime REAL, subdirs TEXT, "
+					"own TEXT, cover TEXT, cover_mtime REAL, "
+					"generation INTEGER)")
+			signature = repr((self.SCHEMA_VERSION, self.music_path,
+					matcher.rules, depth))
+			row = self.db.execute("SELECT value FROM meta "
+					"WHERE key = 'signature'").fetchone()
+			if row is None or row[0] != signature:
+				self.db.execute("DELETE FROM covers")
+				self.db.execute("INSERT OR REPLACE INTO meta (key, value) "
+						"VALUES ('signature', ?)", (signature,))
+			self.db.commit()
+
+	def lookup(self, dirname):
+		"""Return the cover path (or None if there is no cover) for a 
+		directory. Raise KeyError if the directory hasn't been indexed."""
+		with self.lock:
+			row = self.db.execute("SELECT cover FROM covers "
+					"WHERE directory = ?", (os.path.normpath(dirname),)
+					).fetchone()
+		if row is None:
+			raise KeyError(dirname)
+		return row[0]
+
+	def rescan(self):
+		"""Request a scan in the background; requests made while a scan is 
+		running are coalesced into one more scan"""
+		self.pending.set()
+		if self.thread is None:
+			self.thread = threading.Thread(target=self._run,
+					name="cover index")
+			self.thread.daemon = True
+			self.thread.start()
+
+	def _run(self):
+		while True:
+			self.pending.wait()
+			self.pending.clear()
+			try:
+				changed = self._scan()
+			except (sqlite3.Error, OSError), e:
+				print "Cover index scan failed: %s" % e
+				continue
+			if changed and self.on_change is not None:
+				glib.idle_add(self._changed)
+
+	def _changed(self):
+		self.on_change()
+		return False
+
+	def _scan(self):
+		"""Walk the music path updating the index, return true if any 
+		directory's cover changed"""
+		with self.lock:
+			row = self.db.execute("SELECT value FROM meta "
+					"WHERE key = 'generation'").fetchone()
+		generation = 1 if row is None else int(row[0]) + 1
+
+		changed = False
+		visited = set()
+		batch = []
+		# stack of (directory, covers of ancestors, nearest first)
+		stack = [(self.music_path, [])]
+		while stack:
+			path, ancestors = stack.pop()
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue
+			if (st.st_dev, st.st_ino) in visited:
+				continue # symlink loop
+			visited.add((st.st_dev, st.st_ino))
+
+			with self.lock:
+				row = self.db.execute("SELECT mtime, subdirs, own, cover, "
+						"cover_mtime FROM covers WHERE directory = ?",
+						(path,)).fetchone()
+			if row is not None and row[0] == st.st_mtime:
+				subdirs = row[1].split("\n") if row[1] else []
+				own = row[2]
+			else:
+				try:
+					names = os.listdir(path)
+				except OSError:
+					continue
+				subdirs = [n for n in names
+						if os.path.isdir(os.path.join(path, n))]
+				dirs = set(subdirs)
+				own = self.matcher.match(n for n in names if n not in dirs)
+
+			ownpath = None if own is None else os.path.join(path, own)
+			cover = None
+			for candidate in [ownpath] + ancestors[:self.depth]:
+				if candidate is not None:
+					cover = candidate
+					break
+			cover_mtime = None
+			if cover is not None:
+				try:
+					cover_mtime = os.stat(cover).st_mtime
+				except OSError:
+					cover = None
+			if row is None or row[3] != cover or row[4] != cover_mtime:
+				changed = True
+
+			batch.append((path, st.st_mtime, "\n".join(subdirs), own, cover,
+					cover_mtime, generation))
+			if len(batch) >= 500:
+				self._write(batch)
+				batch = []
+
+			for sub in subdirs:
+				stack.append((os.path.join(path, sub), [ownpath] + ancestors))
+
+		self._write(batch)
+		with self.lock:
+			cursor = self.db.execute("DELETE FROM covers "
+					"WHERE generation != ?", (generation,))
+			if cursor.rowcount:
+				changed = True
+			self.db.execute("INSERT OR REPLACE INTO meta (key, value) "
+					"VALUES ('generation', ?)", (str(generation),))
+			self.db.commit()
+		return changed
+
+	def _write(self, batch):
+		with self.lock:
+			self.db.executemany("INSERT OR REPLACE INTO covers (directory, "
+					"mtime, subdirs, own, cover, cover_mtime, generation) "
+					"VALUES (?, ?, ?, ?, ?, ?, ?)", batch)
+			self.db.commit()
+
+# embedded cover art
+# ------------------------------------------------------------------------------
+
+# larger "pictures" are assumed to be corrupt tags
+MAX_PICTURE_SIZE = 16 * 1024 * 1024
+
+def extract_picture(path):
+	"""Return the data of the picture embedded in the audio file at path, 
+	preferring the front cover if there are several, or None if there isn't 
+	one or the file isn't MP3, FLAC or MP4. Only the tags are read, not the 
+	audio. Raises EnvironmentError if the file can't be read and ValueError 
+	if its tags are corrupt."""
+	with open(path, "rb") as f:
+		header = f.read(12)
+		start = 0
+		if header[:3] == "ID3":
+			picture = _id3_picture(f)
+			if picture is not None:
+				return picture
+			# FLAC files sometimes have an ID3 tag in front
+			start = f.tell()
+			header = f.read(4)
+		if header[:4] == "fLaC":
+			f.seek(start + 4)
+			return _flac_picture(f)
+		if header[4:8] == "ftyp":
+			f.seek(0, os.SEEK_END)
+			return _mp4_picture(f, 0, f.tell())
+	return None
+
+def _syncsafe(data):
+	"""Decode an ID3v2 integer of seven bits per byte"""
+	value = 0
+	for byte in data:
+		value = value << 7 | ord(byte) & 0x7f
+	return value
+
+def _best_picture(pictures):
+	"""Given (picture type, data) pairs return the front cover's data, or the 
+	first picture's, or None"""
+	for kind, data in pictures:
+		if kind == 3:
+			return data
+	if pictures:
+		return pictures[0][1]
+	return None
+
+def _id3_picture(f):
+	"""Return the picture in the ID3v2 tag at the start of f, leaving f just 
+	after the tag"""
+	f.seek(0)
+	header = f.read(10)
+	version, flags = ord(header[3]), ord(header[5])
+	size = _syncsafe(header[6:10])
+	if size > MAX_PICTURE_SIZE:
+		# too big to be worth reading, and probably corrupt; skip it
+		f.seek(10 + size)
+		return None
+	tag = f.read(size)
+	if len(tag) < size:
+		raise ValueError("truncated ID3 tag")
+	if version < 2 or version > 4:
+		return None
+	if flags & 0x80 and version < 4:
+		# the whole tag is unsynchronised
+		tag = tag.replace("\xff\x00", "\xff")
+	position = 0
+	if flags & 0x40 and version >= 3:
+		# skip the extended header
+		if version == 3:
+			position = struct.unpack(">I", tag[:4])[0] + 4
+		else:
+			position = _syncsafe(tag[:4])
+
+	pictures = []
+	while position + 10 <= len(tag):
+		if version == 2:
+			frame = tag[position:position + 3]
+			length = struct.unpack(">I",
+					"\x00" + tag[position + 3:position + 6])[0]
+			frame_flags = 0
+			position += 6
+		else:
+			frame = tag[position:position + 4]
+			if version == 3:
+				length = struct.unpack(">I", tag[position + 4:position + 8])[0]
+			else:
+				length = _syncsafe(tag[position + 4:position + 8])
+			frame_flags = struct.unpack(">H",
+					tag[position + 8:position + 10])[0]
+			position += 10
+		if not frame.strip("\x00"):
+			break # padding
+		data = tag[position:position + length]
+		position += length
+		if frame not in ("PIC", "APIC"):
+			continue
+		if version == 3 and frame_flags & 0xc0 \
+				or version == 4 and frame_flags & 0x0c:
+			continue # compressed or encrypted
+		if version == 4:
+			if frame_flags & 0x01:
+				data = data[4:] # data length indicator
+			if frame_flags & 0x02:
+				data = data.replace("\xff\x00", "\xff")
+		picture = _apic(data, frame == "PIC")
+		if picture is not None:
+			pictures.append(picture)
+	return _best_picture(pictures)
+
+def _apic(data, v22):
+	"""Return (picture type, image data) from an APIC (or ID3v2.2 PIC) frame, 
+	or None if it's malformed"""
+	if len(data) < 5:
+		return None
+	encoding = ord(data[0])
+	if v22:
+		# three character image format
+		position = 4
+	else:
+		# null-terminated MIME type
+		position = data.find("\x00", 1) + 1
+		if position == 0:
+			return None
+	kind = ord(data[position])
+	position += 1
+	if encoding in (1, 2):
+		# UTF-16 description, terminated by an aligned pair of nulls
+		end = position
+		while True:
+			end = data.find("\x00\x00", end)
+			if end == -1:
+				return None
+			if (end - position) % 2 == 0:
+				break
+			end += 1
+		position = end + 2
+	else:
+		end = data.find("\x00", position)
+		if end == -1:
+			return None
+		position = end + 1
+	return kind, data[position:]
+
+def _flac_picture(f):
+	"""Return the picture in the FLAC metadata blocks following the fLaC 
+	marker just read from f"""
+	pictures = []
+	while True:
+		header = f.read(4)
+		if len(header) < 4:
+			raise ValueError("truncated FLAC metadata")
+		last = ord(header[0]) & 0x80
+		kind = ord(header[0]) & 0x7f
+		length = struct.unpack(">I", "\x00" + header[1:])[0]
+		if kind == 6 and length <= MAX_PICTURE_SIZE:
+			block = f.read(length)
+			picture_type, mime_length = struct.unpack(">II", block[:8])
+			position = 8 + mime_length
+			description_length = struct.unpack(">I",
+					block[position:position + 4])[0]
+			position += 4 + description_length + 16
+			data_length = struct.unpack(">I", block[position:position + 4])[0]
+			position += 4
+			pictures.append((picture_type,
+					block[position:position + data_length]))
+		else:
+			f.seek(length, os.SEEK_CUR)
+		if last:
+			break
+	return _best_picture(pictures)
+
+def _mp4_atoms(f, start, end):
+	"""Yield (type, payload start, payload end) for each MP4 atom between 
+	offsets start and end of f"""
+	position = start
+	while position + 8 <= end:
+		f.seek(position)
+		size, kind = struct.unpack(">I4s", f.read(8))
+		header = 8
+		if size == 1:
+			size = struct.unpack(">Q", f.read(8))[0]
+			header = 16
+		elif size == 0:
+			size = end - position
+		if size < header:
+			raise ValueError("bad MP4 atom size")
+		yield kind, position + header, min(position + size, end)
+		position += size
+
+def _mp4_picture(f, start, end, path=("moov", "udta", "meta", "ilst", "covr")):
+	"""Return the cover art in an MP4 file's iTunes metadata, walking down 
+	the atoms on the given path without reading the others"""
+	for kind, payload_start, payload_end in _mp4_atoms(f, start, end):
+		if kind != path[0]:
+			continue
+		if len(path) > 1:
+			if kind == "meta":
+				# a full atom, with a version and flags before its children, 
+				# except in some QuickTime files
+				f.seek(payload_start)
+				if f.read(4) == "\x00\x00\x00\x00":
+					payload_start += 4
+			return _mp4_picture(f, payload_start, payload_end, path[1:])
+		# the covr atom holds a data atom for each picture
+		for data_kind, data_start, data_end in _mp4_atoms(f, payload_start,
+				payload_end):
+			if data_kind == "data" and data_end - data_start > 8 \
+					and data_end - data_start <= MAX_PICTURE_SIZE:
+				f.seek(data_start + 8) # skip the type and locale
+				return f.read(data_end - data_start - 8)
+		return None
+	return None
+
+def picture_extension(data):
+	"""Return a filename extension for image data"""
+	if data.startswith("\xff\xd8"):
+		return ".jpg"
+	if data.startswith("\x89PNG"):
+		return ".png"
+	if data.startswith("GIF8"):
+		return ".gif"
+	if data.startswith("BM"):
+		return ".bmp"
+	return ".img"
+
+class EmbeddedCovers:
+	"""Cover art embedded in audio files, extracted into a cache directory as 
+	files named after a hash of their contents. Every track embedding the 
+	same picture so shares one file, and with it the decoded and resized 
+	images cached for that file. Which picture each audio file has is kept in 
+	an SQLite database with the audio file's mtime and size, so a file is 
+	only read again when it changes."""
+	directory = None
+	db = None
+	lock = None
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(os.path.join(directory, "embedded.sqlite"),
+				check_same_thread=False)
+		self.db.text_factory = str
+		with self.lock:
+			self.db.execute("CREATE TABLE IF NOT EXISTS pictures ("
+					"path TEXT PRIMARY KEY, mtime REAL, size INTEGER, "
+					"picture TEXT)")
+			self.db.commit()
+
+	def find(self, path):
+		"""Return the path of a file holding the picture embedded in the audio 
+		file at path, or None if it has none"""
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return None
+		with self.lock:
+			row = self.db.execute("SELECT mtime, size, picture FROM pictures "
+					"WHERE path = ?", (path,)).fetchone()
+		if row is not None and row[:2] == (stat.st_mtime, stat.st_size):
+			if row[2] is None:
+				return None
+			picture = os.path.join(self.directory, row[2])
+			if os.path.exists(picture):
+				return picture
+
+		try:
+			data = extract_picture(path)
+		except EnvironmentError:
+			return None
+		except (ValueError, struct.error, IndexError), e:
+			print "Failed to read the cover art in %s: %s" % (path, e)
+			data = None
+		name = None
+		if data:
+			name = hashlib.sha1(data).hexdigest() + picture_extension(data)
+			picture = os.path.join(self.directory, name)
+			if not os.path.exists(picture):
+				try:
+					with open(picture + ".tmp", "wb") as f:
+						f.write(data)
+					os.rename(picture + ".tmp", picture)
+				except EnvironmentError, e:
+					print "Failed to cache cover art: %s" % e
+					return None
+		with self.lock:
+			self.db.execute("INSERT OR REPLACE INTO pictures (path, mtime, "
+					"size, picture) VALUES (?, ?, ?, ?)",
+					(path, stat.st_mtime, stat.st_size, name))
+			self.db.commit()
+		if name is None:
+			return None
+		return os.path.join(self.directory, name)
+
+# remote cover art
+# ------------------------------------------------------------------------------
+
+class PictureUnavailable(Exception):
+	"""MPD refused a picture command, usually because there's no picture"""
+
+class PictureClient:
+	"""A connection to MPD of its own for fetching cover art with the albumart 
+	and readpicture commands, which the MPD client library doesn't support, 
+	so that it doesn't hold up the idle connection. Pictures come in chunks, 
+	made few by asking for a large binarylimit, and are written to a file as 
+	they arrive."""
+	CHUNK_SIZE = 1024 * 1024
+	host = None
+	port = None
+	password = None
+	timeout = None
+	socket = None
+	file = None
+	lock = None
+
+	def __init__(self, host, port, password=None, timeout=None):
+		self.host = host
+		self.port = port
+		self.password = password
+		self.timeout = timeout
+		self.lock = threading.Lock()
+
+	def fetch(self, command, uri, out):
+		"""Write the picture the albumart or readpicture command gives for 
+		uri to the file out, returning true, or return false if there isn't 
+		one. Raises socket.error or ValueError if the connection fails."""
+		with self.lock:
+			reused = self.socket is not None
+			if not reused:
+				self._connect()
+			try:
+				return self._fetch(command, uri, out)
+			except (socket.error, ValueError):
+				self.close()
+				if not reused:
+					raise
+			# MPD closes connections idle for longer than its 
+			# connection_timeout, so try once more on a fresh one
+			out.seek(0)
+			out.truncate()
+			self._connect()
+			try:
+				return self._fetch(command, uri, out)
+			except (socket.error, ValueError):
+				self.close()
+				raise
+
+	def _fetch(self, command, uri, out):
+		offset = 0
+		while True:
+			try:
+				fields, data = self._command(command, uri, str(offset))
+			except PictureUnavailable:
+				return False
+			if data is None:
+				return False # readpicture says nothing when there's nothing
+			out.write(data)
+			offset += len(data)
+			if offset >= int(fields["size"]):
+				return True
+			if not data:
+				raise ValueError("MPD sent an empty chunk")
+
+	def _connect(self):
+		if self.host.startswith("/"):
+			self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			self.socket.settimeout(self.timeout)
+			self.socket.connect(self.host)
+		else:
+			self.socket = socket.create_connection((self.host, self.port),
+					self.timeout)
+		self.file = self.socket.makefile("rb")
+		try:
+			if not self.file.readline().startswith("OK MPD "):
+				raise ValueError("not an MPD server")
+			if self.password is not None:
+				try:
+					self._command("password", self.password)
+				except PictureUnavailable:
+					raise ValueError("password refused")
+			try:
+				self._command("binarylimit", str(self.CHUNK_SIZE))
+			except PictureUnavailable:
+				pass # MPD older than 0.22.4 sends 8KiB chunks
+		except (socket.error, ValueError):
+			self.close()
+			raise
+
+	def _command(self, *words):
+		"""Send a command and return a dictionary of the fields in the 
+		response and its binary data, or None if there was none"""
+		self.socket.sendall(" ".join([words[0]] + ['"%s"'
+				% word.replace("\\", "\\\\").replace('"', '\\"')
+				for word in words[1:]]) + "\n")
+		fields = {}
+		while True:
+			line = self.file.readline()
+			if not line.endswith("\n"):
+				raise socket.error("connection closed by MPD")
+			if line == "OK\n":
+				return fields, None
+			if line.startswith("ACK "):
+				raise PictureUnavailable(line[4:].strip())
+			key, separator, value = line[:-1].partition(": ")
+			if key == "binary":
+				length = int(value)
+				data = self.file.read(length)
+				if len(data) < length or self.file.read(1) != "\n" \
+						or self.file.readline() != "OK\n":
+					raise ValueError("malformed binary response")
+				return fields, data
+			fields[key] = value
+
+	def close(self):
+		if self.socket is not None:
+			try:
+				self.socket.close()
+			except socket.error:
+				pass
+		self.socket = None
+		self.file = None
+
+class RemoteCovers:
+	"""Cover art fetched from MPD, kept in a cache directory so each picture 
+	crosses the network once. A cover file in the album's directory is keyed 
+	by server and directory, and a picture embedded in a song by server and 
+	song, since neighbouring songs needn't share one. They're recorded in an 
+	SQLite database, refetched after POSITIVE_TTL seconds in case they've 
+	changed, which also remembers for NEGATIVE_TTL seconds that there was 
+	none."""
+	POSITIVE_TTL = 7 * 24 * 60 * 60
+	NEGATIVE_TTL = 24 * 60 * 60
+	directory = None
+	db = None
+	lock = None
+
+	def __init__(self, directory):
+		self.directory = directory
+		self.lock = threading.Lock()
+		self.db = sqlite3.connect(os.path.join(directory, "remote.sqlite"),
+				check_same_thread=False)
+		self.db.text_factory = str
+		with self.lock:
+			self.db.execute("CREATE TABLE IF NOT EXISTS covers ("
+					"server TEXT, command TEXT, key TEXT, picture TEXT, "
+					"fetched REAL, PRIMARY KEY (server, command, key))")
+			self.db.commit()
+
+	def find(self, client, server, uri):
+		"""Return the path of the cached cover art for the song at uri on the 
+		named server, fetching it with client if it isn't cached, or None if 
+		MPD has none. Raises socket.error or ValueError if fetching fails."""
+		fetched = False
+		try:
+			# a cover file in the album's directory, otherwise a picture 
+			# embedded in the song
+			for command, key in (("albumart", os.path.dirname(uri)),
+					("readpicture", uri)):
+				known, path = self._lookup(server, command, key)
+				if not known:
+					fetched = True
+					path = self._fetch(client, server, command, key, uri)
+				if path is not None:
+					return path
+			return None
+		finally:
+			metrics.count("cache_requests_total", cache="remote",
+					result="miss" if fetched else "hit")
+
+	def _lookup(self, server, command, key):
+		"""Return whether the answer is known and fresh, and the picture's 
+		path or None"""
+		with self.lock:
+			row = self.db.execute("SELECT picture, fetched FROM covers "
+					"WHERE server = ? AND command = ? AND key = ?",
+					(server, command, key)).fetchone()
+		if row is None:
+			return False, None
+		picture, fetched = row
+		if picture is None:
+			return fetched > time.time() - self.NEGATIVE_TTL, None
+		path = os.path.join(self.directory, picture)
+		if fetched > time.time() - self.POSITIVE_TTL and os.path.exists(path):
+			return True, path
+		return False, None
+
+	def _fetch(self, client, server, command, key, uri):
+		"""Fetch a picture with the given command, record it and return its 
+		path, or None if there's none"""
+		name = hashlib.sha1("%s\0%s\0%s" % (server, command, key)).hexdigest()
+		path = os.path.join(self.directory, name)
+		found = False
+		try:
+			with open(path + ".tmp", "wb") as out:
+				found = client.fetch(command, uri, out)
+			if found:
+				os.rename(path + ".tmp", path)
+		finally:
+			if os.path.exists(path + ".tmp"):
+				os.unlink(path + ".tmp")
+		with self.lock:
+			self.db.execute("INSERT OR REPLACE INTO covers (server, command, "
+					"key, picture, fetched) VALUES (?, ?, ?, ?, ?)",
+					(server, command, key, name if found else None,
+							time.time()))
+			self.db.commit()
+		return path if found else None
+
+# images
+# ------------------------------------------------------------------------------
+
+def resize_image(image, size, fast=False):
+	"""Resize a PIL image to size by size. In fast mode it's first repeatedly 
+	halved with a cheap filter while that leaves it at least twice the target 
+	size, so the final high quality resample has little left to do."""
+	if fast:
+		width, height = image.size
+		while width >= size * 4 and height >= size * 4:
+			width, height = width / 2, height / 2
+			image = image.resize((width, height), Image.BILINEAR)
+	return image.resize((size, size), Image.ANTIALIAS)
+
+
+class ImageCache:
+	"""Bounded in-memory least-recently-used cache of decoded cover art.
+
+	Images are keyed by (cover path, cover mtime) and stored along with a flag 
+	saying whether they are at the cover's full resolution; otherwise they 
+	have been scaled down to the largest size needed at the time they were 
+	decoded and can only serve that size or smaller."""
+	budget = None
+	used = None
+	images = None
+	lock = None
+
+	def __init__(self, budget):
+		"""Keep at most budget bytes of pixel data"""
+		self.budget = budget
+		self.used = 0
+		self.images = collections.OrderedDict()
+		self.lock = threading.Lock()
+
+	def get(self, key, size):
+		"""Return the image for key if one is cached which can be resized to 
+		size without upscaling, otherwise None"""
+		with self.lock:
+			entry = self.images.pop(key, None)
+			if entry is None:
+				return None
+			self.images[key] = entry
+			image, complete = entry
+			if complete or min(image.size) >= size:
+				return image
+			return None
+
+	def put(self, key, image, complete):
+		with self.lock:
+			old = self.images.pop(key, None)
+			if old is not None:
+				self.used -= self._bytes(old[0])
+			cost = self._bytes(image)
+			if cost > self.budget:
+				return
+			while self.used + cost > self.budget:
+				evicted, entry = self.images.popitem(last=False)
+				self.used -= self._bytes(entry[0])
+			self.images[key] = (image, complete)
+			self.used += cost
+
+	def _bytes(self, image):
+		return image.size[0] * image.size[1] * len(image.getbands())
+
+
+class ThumbnailStore:
+	"""Persistent store of resized cover art as raw pixel rows, ready to be 
+	wrapped in a pixbuf without decoding or resampling.
+
+	The pixel data of all thumbnails is packed into one file which is memory 
+	mapped for reading; an SQLite index maps (cover path, cover mtime, size) 
+	to each thumbnail's position and geometry and records when it was last 
+	used. When adding a thumbnail would take the live data over the budget the 
+	least recently used thumbnails are evicted, and the pack file is compacted 
+	when it can't otherwise hold the new data. Several MPN processes can share 
+	a store: changes are made under a lock file, and a compaction bumps a 
+	generation number which tells the others to remap."""
+	db = None
+	budget = None
+	pack_path = None
+	lock_file = None
+	pack = None
+	map = None
+	map_generation = None
+	lock = None
+
+	def __init__(self, directory, budget):
+		"""Open (or create) a store in the given directory, keeping at most 
+		budget bytes of pixel data"""
+		self.budget = budget
+		self.pack_path = os.path.join(directory, "thumbnails.pack")
+		self.lock = threading.RLock()
+		self.lock_file = open(os.path.join(directory, "thumbnails.lock"), "a")
+		self.db = sqlite3.connect(os.path.join(directory, "thumbnails.sqlite"),
+				check_same_thread=False)
+		self.db.text_factory = str
+		# it's only a cache, so don't wait for the disk on every hit
+		self.db.execute("PRAGMA synchronous = OFF")
+		with self._locked(fcntl.LOCK_EX):
+			self.db.execute("CREATE TABLE IF NOT EXISTS meta ("
+					"key TEXT PRIMARY KEY, value TEXT)")
+			self.db.execute("CREATE TABLE IF NOT EXISTS thumbnails ("
+					"path TEXT, mtime REAL, size INTEGER, "
+					"offset INTEGER, length INTEGER, "
+					"width INTEGER, height INTEGER, has_alpha INTEGER, "
+					"rowstride INTEGER, last_used REAL, "
+					"PRIMARY KEY (path, mtime, size))")
+			self.db.execute("CREATE INDEX IF NOT EXISTS thumbnails_last_used "
+					"ON thumbnails (last_used)")
+			if not os.path.exists(self.pack_path):
+				# the pack is gone so the index is meaningless
+				self.db.execute("DELETE FROM thumbnails")
+				open(self.pack_path, "wb").close()
+			self.db.commit()
+
+	def get(self, path, mtime, size):
+		"""Return a pixbuf of the thumbnail or None if there isn't one"""
+		with self._locked(fcntl.LOCK_SH):
+			row = self.db.execute("SELECT offset, length, width, height, "
+					"has_alpha, rowstride FROM thumbnails "
+					"WHERE path = ? AND mtime = ? AND size = ?",
+					(path, mtime, size)).fetchone()
+			if row is None:
+				return None
+			offset, length, width, height, has_alpha, rowstride = row
+			self._remap()
+			if self.map is None or offset + length > len(self.map):
+				return None
+			data = self.map[offset:offset + length]
+			self.db.execute("UPDATE thumbnails SET last_used = ? "
+					"WHERE path = ? AND mtime = ? AND size = ?",
+					(time.time(), path, mtime, size))
+			self.db.commit()
+		return gtk.gdk.pixbuf_new_from_data(data, gtk.gdk.COLORSPACE_RGB,
+				bool(has_alpha), 8, width, height, rowstride)
+
+	def put(self, path, mtime, size, data, width, height, has_alpha,
+			rowstride):
+		"""Add a thumbnail given its raw pixel rows"""
+		length = len(data)
+		if length > self.budget:
+			return
+		with self._locked(fcntl.LOCK_EX):
+			# older versions of this cover will never be asked for again
+			self.db.execute("DELETE FROM thumbnails "
+					"WHERE path = ? AND (mtime != ? OR size = ?)",
+					(path, mtime, size))
+
+			# evict least recently used thumbnails until the new one fits
+			live = self.db.execute("SELECT COALESCE(SUM(length), 0) "
+					"FROM thumbnails").fetchone()[0]
+			while live + length > self.budget:
+				row = self.db.execute("SELECT path, mtime, size, length "
+						"FROM thumbnails ORDER BY last_used LIMIT 1"
+						).fetchone()
+				self.db.execute("DELETE FROM thumbnails "
+						"WHERE path = ? AND mtime = ? AND size = ?", row[:3])
+				live -= row[3]
+
+			end = os.path.getsize(self.pack_path)
+			if end + length > self.budget:
+				end = self._compact()
+
+			with open(self.pack_path, "r+b") as f:
+				f.seek(end)
+				f.write(data)
+			self.db.execute("INSERT INTO thumbnails (path, mtime, size, "
+					"offset, length, width, height, has_alpha, rowstride, "
+					"last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+					(path, mtime, size, end, length, width, height,
+							int(has_alpha), rowstride, time.time()))
+			self.db.commit()
+
+	def _compact(self):
+		"""Rewrite the pack with only live thumbnails, return its new end"""
+		self._remap()
+		rows = self.db.execute("SELECT path, mtime, size, offset, length "
+				"FROM thumbnails ORDER BY offset").fetchall()
+		tmp_path = self.pack_path + ".tmp"
+		end = 0
+		with open(tmp_path, "wb") as f:
+			for path, mtime, size, offset, length in rows:
+				f.write(self.map[offset:offset + length])
+				self.db.execute("UPDATE thumbnails SET offset = ? "
+						"WHERE path = ? AND mtime = ? AND size = ?",
+						(end, path, mtime, size))
+				end += length
+		os.rename(tmp_path, self.pack_path)
+		self.db.execute("INSERT OR REPLACE INTO meta (key, value) "
+				"VALUES ('generation', ?)", (str(self._generation() + 1),))
+		self.db.commit()
+		return end
+
+	def _generation(self):
+		row = self.db.execute("SELECT value FROM meta "
+				"WHERE key = 'generation'").fetchone()
+		return 0 if row is None else int(row[0])
+
+	def _remap(self):
+		"""Make sure the mapping covers the current pack file"""
+		generation = self._generation()
+		size = os.path.getsize(self.pack_path)
+		if self.map is not None and self.map_generation == generation \
+				and len(self.map) == size:
+			return
+		if self.map is not None:
+			self.map.close()
+			self.pack.close()
+			self.map = None
+		if size == 0:
+			return
+		self.pack = open(self.pack_path, "rb")
+		self.map = mmap.mmap(self.pack.fileno(), size, access=mmap.ACCESS_READ)
+		self.map_generation = generation
+
+	@contextlib.contextmanager
+	def _locked(self, operation):
+		"""Hold the thread lock and the file lock"""
+		with self.lock:
+			fcntl.flock(self.lock_file.fileno(), operation)
+			try:
+				yield
+			finally:
+				fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
 # svg
 # ------------------------------------------------------------------------------
 
@@ -130,55 +1519,55 @@ def make_svg(icon, s):
 		r = [x * s for x in [0.5, 0.05, 0.48, 0.13]]
 
 		# start definitions block
-		body = "<defs>\n"
+		body = ["<defs>\n"]
 
 		# mask for the whole CD
-		body = body + """
+		body.append("""
 				<mask id="cd">
 					<circle cx="0" cy="0" r="%f" fill="white"/>
 					<circle cx="0" cy="0" r="%f" fill="black"/>
-				</mask>""" % (r[0], r[1])
+				</mask>""" % (r[0], r[1]))
 
 		# mask for the shiny area
-		body = body + """
+		body.append("""
 				<mask id="shinybit">
 					<circle cx="0" cy="0" r="%f" fill="white"/>
 					<circle cx="0" cy="0" r="%f" fill="black"/>
-				</mask>""" % (r[2], r[3])
+				</mask>""" % (r[2], r[3]))
 
 		# gaussian blur for the shine
-		body = body + """
+		body.append("""
 				<filter id="blur">
 					<feGaussianBlur stdDeviation="%f"/>
-				</filter>""" % (0.05*s)
+				</filter>""" % (0.05*s))
 
 		# shape for the shine
-		body = body + """<path id="shine" d="m %f,%f %f,0 %f,%f %f,0 z"/>\n""" \
-				% (-s, -s, 2*s, -2*s, 2*s, 2*s)
+		body.append("""<path id="shine" d="m %f,%f %f,0 %f,%f %f,0 z"/>\n""" \
+				% (-s, -s, 2*s, -2*s, 2*s, 2*s))
 
 		# gradient for gloss
-		body = body + """
+		body.append("""
 				<linearGradient id="whitefade"
 						x1="0" y1="0" x2="0" y2="100%%">
 					<stop offset="0%%" stop-color="white" stop-opacity="0"/>
 					<stop offset="100%%" stop-color="white" stop-opacity="1"/>
-				</linearGradient>\n"""
+				</linearGradient>\n""")
 
 		# end definitions block
-		body = body + "</defs>\n"
+		body.append("</defs>\n")
 
 		# group masking to the CD's shape and shifting everything into view so 
 		# 0,0 can be the centre
-		body = body + """<g mask="url(#cd)"
-				transform="translate(%f, %f)">\n""" % (0.5*s, 0.5*s)
+		body.append("""<g mask="url(#cd)"
+				transform="translate(%f, %f)">\n""" % (0.5*s, 0.5*s))
 
 		# transparent outside, only visible when large
-		body = body + """<circle cx="0" cy="0" r="%f"
+		body.append("""<circle cx="0" cy="0" r="%f"
 				fill="none" stroke="#d0d0d0" stroke-width="%f"
-				opacity="0.4"/>""" % (0.5*s, 0.3*s)
+				opacity="0.4"/>""" % (0.5*s, 0.3*s))
 
 		# shiny bit
-		body = body + """
+		body.append("""
 				<g mask="url(#shinybit)">
 					<circle cx="0" cy="0" r="%f" fill="#b3b3b3"/>
 					<g filter="url(#blur)">
@@ -199,21 +1588,21 @@ def make_svg(icon, s):
 									transform="rotate(95) scale(0.1, 1)"/>
 						</g>
 					</g>
-				</g>\n""" % (r[0])
+				</g>\n""" % (r[0]))
 
 		# transparent centre bit
-		body = body + """<circle cx="0" cy="0" r="%f"
+		body.append("""<circle cx="0" cy="0" r="%f"
 				fill="#4b4b4b"
-				opacity="0.30"/>""" % (0.16*s)
-		body = body + """<circle cx="0" cy="0" r="%f"
+				opacity="0.30"/>""" % (0.16*s))
+		body.append("""<circle cx="0" cy="0" r="%f"
 				fill="none" stroke="#2b2b2b" stroke-width="1"
-				opacity="0.15"/>""" % (0.105*s)
-		body = body + """<circle cx="0" cy="0" r="%f"
+				opacity="0.15"/>""" % (0.105*s))
+		body.append("""<circle cx="0" cy="0" r="%f"
 				fill="none" stroke="#2b2b2b" stroke-width="1"
-				opacity="0.15"/>""" % (0.07*s)
+				opacity="0.15"/>""" % (0.07*s))
 
 		# gloss
-		body = body + """<path
+		body.append("""<path
 				d="m %f,%f
 					C %f,%f %f,%f %f,%f
 					C %f,%f %f,%f %f,%f
@@ -225,23 +1614,23 @@ def make_svg(icon, s):
 						-0.03*s, -0.03*s, 0.03*s, 0.03*s, 0.2*s, 0.03*s,
 						0.35*s, 0.03*s, 0.45*s, 0, 0.5*s, -0.05*s,
 						-0.5*s, -0.5*s, # corners
-						)
+						))
 
 		# 1 pixel light rim
-		body = body + """<circle cx="0" cy="0" r="%f"
+		body.append("""<circle cx="0" cy="0" r="%f"
 				fill="none" stroke="#e0e0e0" stroke-width="4"
-				opacity="0.8"/>""" % (0.5*s)
+				opacity="0.8"/>""" % (0.5*s))
 
 		# 1 pixel dark outline
-		body = body + """<circle cx="0" cy="0" r="%f"
+		body.append("""<circle cx="0" cy="0" r="%f"
 				fill="none" stroke="#606060" stroke-width="2"
-				opacity="0.7"/>""" % (0.5*s)
-		body = body + """<circle cx="0" cy="0" r="%f"
+				opacity="0.7"/>""" % (0.5*s))
+		body.append("""<circle cx="0" cy="0" r="%f"
 				fill="none" stroke="#606060" stroke-width="2"
-				opacity="0.3"/>""" % (r[1])
+				opacity="0.3"/>""" % (r[1]))
 
 		# end group
-		body = body + "</g>\n"
+		body.append("</g>\n")
 	else:
 		# usable size (size minus 1-pixel outline on each side)
 		u = s - 2
@@ -278,19 +1667,20 @@ def make_svg(icon, s):
 						],
 				}
 
-		body = ""
+		body = []
 		for path in paths[icon]:
+			d = " ".join("%s,%s" % p for p in path)
+
 			# outline
-			body = """%s<path d="m %s z"
-					fill="none" stroke="black" stroke-width="2" opacity="0.8"/>""" \
-					% (body, " ".join("%s,%s" % p for p in path))
+			body.append("""<path d="m %s z"
+					fill="none" stroke="black" stroke-width="2" opacity="0.8"/>"""
+					% d)
 
 			# fill
-			body = """%s<path d="m %s z"
-					fill="white" stroke="none" opacity="0.8"/>""" \
-					% (body, " ".join("%s,%s" % p for p in path))
+			body.append("""<path d="m %s z"
+					fill="white" stroke="none" opacity="0.8"/>""" % d)
 
-	return "%s%s%s" % (header, body, footer)
+	return "%s%s%s" % (header, "".join(body), footer)
 
 def svg_to_pixbuf(svg):
 	pl = gtk.gdk.PixbufLoader("svg")
@@ -298,25 +1688,871 @@ def svg_to_pixbuf(svg):
 	pl.close()
 	return pl.get_pixbuf()
 
+class IconCache:
+	"""Rasterized icons, rendered once per (icon name, size).
+
+	Pixbufs are kept for the life of the process and, if a directory is set, 
+	saved there as PNGs named after a hash of their SVG so later processes can 
+	load them instead of running librsvg. Cached pixbufs are shared, so 
+	callers must copy them before drawing on them."""
+	directory = None
+	pixbufs = None
+	lock = None
+
+	def __init__(self, directory=None):
+		self.directory = directory
+		self.pixbufs = {}
+		self.lock = threading.Lock()
+
+	def get(self, icon, size):
+		"""Return a pixbuf of the named icon at the given size"""
+		key = (icon, size)
+		with self.lock:
+			pixbuf = self.pixbufs.get(key)
+			if pixbuf is not None:
+				return pixbuf
+
+			svg = make_svg(icon, size)
+			path = None
+			if self.directory is not None:
+				path = os.path.join(self.directory, "%s-%s-%s.png"
+						% (icon, size, hashlib.md5(svg).hexdigest()))
+				try:
+					pixbuf = gtk.gdk.pixbuf_new_from_file(path)
+				except glib.GError:
+					pixbuf = None
+			if pixbuf is None:
+				pixbuf = svg_to_pixbuf(svg)
+				if path is not None:
+					try:
+						pixbuf.save(path + ".tmp", "png")
+						os.rename(path + ".tmp", path)
+					except (glib.GError, OSError):
+						pass
+			self.pixbufs[key] = pixbuf
+			return pixbuf
+
+icons = IconCache()
+
+# mpd state
+# ------------------------------------------------------------------------------
+
+class MPDState:
+	"""What is known of MPD's state: the latest status and current song, 
+	either None when not connected.
+
+	Updates are diffed against what was known before and an event emitted for 
+	each aspect which changed:
+
+	- connection: connected or disconnected
+	- song: the current song, ignoring its position in the queue
+	- state: playing, paused or stopped
+	- options: random, repeat, single, consume or crossfade
+	- volume: the mixer volume
+	- queue: the queue's contents or the next song to be played
+	- database, update: MPD's database changed, or an update started or 
+	  finished; these are only ever emitted when MPD says so"""
+	EVENTS = ("connection", "song", "state", "options", "volume", "queue",
+			"database", "update")
+	OPTIONS = ("random", "repeat", "single", "consume", "xfade")
+	QUEUE = ("playlist", "playlistlength", "nextsongid")
+
+	status = None
+	current = None
+	handlers = None
+
+	def __init__(self):
+		self.handlers = dict((event, []) for event in self.EVENTS)
+
+	def connect(self, event, handler):
+		"""Call handler with no arguments whenever event is emitted"""
+		self.handlers[event].append(handler)
+
+	def emit(self, *events):
+		for event in events:
+			for handler in self.handlers[event]:
+				handler()
+
+	def update(self, status=None, current=None):
+		"""Take new query results (None for those not queried) and return the 
+		set of events for whatever changed. They aren't emitted yet, so the 
+		caller can deal with the most urgent of them before calling emit."""
+		events = set()
+		if status is not None:
+			old = self.status
+			self.status = status
+			if old is None:
+				events.update(("connection", "state", "options", "volume",
+						"queue"))
+			else:
+				if status["state"] != old["state"]:
+					events.add("state")
+				if any(status.get(k) != old.get(k) for k in self.OPTIONS):
+					events.add("options")
+				if status.get("volume") != old.get("volume"):
+					events.add("volume")
+				if any(status.get(k) != old.get(k) for k in self.QUEUE):
+					events.add("queue")
+		if current is not None:
+			old = self.current
+			self.current = current
+			if old is None or self._song(current) != self._song(old):
+				events.add("song")
+		return events
+
+	def reset(self):
+		"""Forget everything, for instance on disconnection"""
+		connected = self.status is not None
+		self.status = None
+		self.current = None
+		if connected:
+			self.emit("connection")
+
+	def _song(self, song):
+		return dict((k, v) for k, v in song.iteritems() if k != "pos")
+
+class PlaybackClock:
+	"""The current song's elapsed time, extrapolated from the last status so 
+	it can be shown up to date without asking MPD. It's anchored on the 
+	status's elapsed time and the monotonic time it arrived, and should be 
+	synced whenever a new status arrives."""
+	base = 0.0
+	anchor = None
+	duration = None
+	playing = False
+
+	def sync(self, status):
+		"""Re-anchor on a status from MPD, or on nothing if it's None"""
+		self.anchor = monotonic()
+		self.base = 0.0
+		self.duration = None
+		self.playing = False
+		if status is None:
+			return
+		self.playing = status.get("state") == "play"
+		time = status.get("time", "").split(":")
+		if "elapsed" in status:
+			self.base = float(status["elapsed"])
+		elif len(time) == 2:
+			self.base = float(time[0])
+		if "duration" in status:
+			self.duration = float(status["duration"])
+		elif len(time) == 2:
+			self.duration = float(time[1])
+
+	def elapsed(self):
+		"""Return seconds elapsed in the current song"""
+		if self.anchor is None:
+			return 0.0
+		elapsed = self.base
+		if self.playing:
+			elapsed += monotonic() - self.anchor
+		if self.duration:
+			elapsed = min(elapsed, self.duration)
+		return elapsed
+
+	def remaining(self):
+		"""Return seconds left in the current song, or None if its length 
+		isn't known"""
+		if not self.duration:
+			return None
+		return max(0.0, self.duration - self.elapsed())
+
+	def progress(self):
+		"""Return the fraction of the current song played, or None if its 
+		length isn't known"""
+		if not self.duration:
+			return None
+		return self.elapsed() / self.duration
+
+	def next_tick(self):
+		"""Return seconds until the elapsed time reaches its next whole 
+		second, or None if it isn't moving"""
+		if not self.playing:
+			return None
+		return 1.0 - self.elapsed() % 1.0
+
+# notification formats
+# ------------------------------------------------------------------------------
+
+class Template:
+	"""A notification format, parsed once into a tree of literal text, fields 
+	and conditional sections so that rendering only looks up the fields the 
+	format actually uses.
+
+	%t, %a, %b, %d, %f, %n and %p are shortcuts for the fields in SHORTCUTS. 
+	%{name} is any field, which is any tag MPD reports for the song; 
+	%{name|other} falls back to the next field when the first is empty. Text 
+	between %[ and %] is left out if every field in it is empty, and %% is a 
+	literal percent sign. Anything else is left as it is."""
+	SHORTCUTS = {
+			"t": "title",
+			"a": "artist",
+			"b": "album",
+			"d": "duration",
+			"f": "file",
+			"n": "track",
+			"p": "pos",
+			}
+
+	format = None
+	tree = None
+	fields = None
+
+	def __init__(self, format):
+		"""Raise ValueError if the format is malformed"""
+		self.format = format
+		self.fields = set()
+		self.tree, i = self._parse(0, False)
+
+	def _parse(self, i, in_section):
+		"""Parse from position i until the end or, in a section, its end 
+		marker. Return the list of nodes (strings for literal text, 
+		("field", names) and ("section", nodes) tuples) and the position after 
+		what was parsed."""
+		format = self.format
+		nodes = []
+		literal = []
+		while i < len(format):
+			c = format[i]
+			n = format[i + 1] if i + 1 < len(format) else ""
+			if c != "%" or n == "":
+				literal.append(c)
+				i += 1
+				continue
+			node = None
+			if n == "%":
+				literal.append("%")
+				i += 2
+			elif n in self.SHORTCUTS:
+				node = ("field", (self.SHORTCUTS[n],))
+				i += 2
+			elif n == "{":
+				end = format.find("}", i + 2)
+				if end == -1:
+					raise ValueError("unterminated %%{ at position %d" % i)
+				names = tuple(name.strip()
+						for name in format[i + 2:end].split("|"))
+				if not all(names):
+					raise ValueError("empty field name at position %d" % i)
+				node = ("field", names)
+				i = end + 1
+			elif n == "[":
+				children, i = self._parse(i + 2, True)
+				node = ("section", children)
+			elif n == "]":
+				if not in_section:
+					raise ValueError("%%] without %%[ at position %d" % i)
+				i += 2
+				break
+			else:
+				literal.append(c)
+				i += 1
+			if node is not None:
+				if literal:
+					nodes.append("".join(literal))
+					literal = []
+				if node[0] == "field":
+					self.fields.update(node[1])
+				nodes.append(node)
+		else:
+			if in_section:
+				raise ValueError("%[ without %]")
+		if literal:
+			nodes.append("".join(literal))
+		return nodes, i
+
+	def render(self, lookup, escape=False, cache=None):
+		"""Render the template, calling lookup(name) for the value of each 
+		field used, at most once each. Values are escaped for markup if escape 
+		is true. A cache dictionary can be given to share values between 
+		several renderings."""
+		if cache is None:
+			cache = {}
+		text, empty = self._render(self.tree, lookup, escape, cache)
+		return text
+
+	def _render(self, nodes, lookup, escape, cache):
+		"""Return the rendered text and whether all its fields were empty"""
+		parts = []
+		empty = True
+		for node in nodes:
+			if isinstance(node, basestring):
+				parts.append(node)
+			elif node[0] == "field":
+				value = ""
+				for name in node[1]:
+					value = self._value(name, lookup, escape, cache)
+					if value:
+						break
+				if value:
+					empty = False
+				parts.append(value)
+			else:
+				text, section_empty = self._render(node[1], lookup, escape,
+						cache)
+				if not section_empty:
+					parts.append(text)
+					empty = False
+		return "".join(parts), empty
+
+	def _value(self, name, lookup, escape, cache):
+		key = (name, escape)
+		if key not in cache:
+			raw = (name, False)
+			if raw not in cache:
+				cache[raw] = lookup(name)
+			cache[key] = cgi.escape(cache[raw]) if escape else cache[raw]
+		return cache[key]
+
+# workers
+# ------------------------------------------------------------------------------
+
+class Job:
+	"""A function call queued for a worker, whose result is passed to a 
+	callback in the main loop unless the job has been cancelled"""
+	function = None
+	args = None
+	callback = None
+	cancelled = False
+
+	def __init__(self, function, args, callback):
+		self.function = function
+		self.args = args
+		self.callback = callback
+
+	def cancel(self):
+		"""Don't start the job if it hasn't been started, and don't call back 
+		if it has"""
+		self.cancelled = True
+
+	def _deliver(self, result):
+		if not self.cancelled:
+			self.callback(result)
+		return False
+
+class JobCancelled(Exception):
+	"""Raised by WorkerPool.check_cancelled in a job which has been 
+	cancelled"""
+
+class WorkerPool:
+	"""Threads running jobs off the main loop so slow work such as finding and 
+	decoding cover art doesn't block GTK or MPD idle handling"""
+	queue = None
+	sequence = None
+	threads = None
+	local = None
+
+	def __init__(self, count, name="worker"):
+		self.queue = Queue.PriorityQueue()
+		self.sequence = itertools.count()
+		self.local = threading.local()
+		self.threads = []
+		for i in range(count):
+			thread = threading.Thread(target=self._run,
+					name="%s %d" % (name, i))
+			thread.daemon = True
+			thread.start()
+			self.threads.append(thread)
+
+	def submit(self, function, callback, *args, **kwargs):
+		"""Queue function to be called with args by a worker and callback to 
+		be called with its result in the main loop. Jobs with a lower priority 
+		keyword argument (default 0) are run first, otherwise they're run in 
+		order. Return the Job."""
+		job = Job(function, args, callback)
+		self.queue.put((kwargs.get("priority", 0), next(self.sequence), job))
+		return job
+
+	def check_cancelled(self):
+		"""Raise JobCancelled if called from a job which has been cancelled, 
+		so long jobs can give up between steps once nobody wants the 
+		result"""
+		job = getattr(self.local, "job", None)
+		if job is not None and job.cancelled:
+			raise JobCancelled()
+
+	def _run(self):
+		while True:
+			priority, sequence, job = self.queue.get()
+			if job.cancelled:
+				continue
+			self.local.job = job
+			try:
+				result = job.function(*job.args)
+			except JobCancelled:
+				continue
+			except Exception:
+				traceback.print_exc()
+				continue
+			finally:
+				self.local.job = None
+			if not job.cancelled:
+				glib.idle_add(job._deliver, result)
+
+# metrics
+# ------------------------------------------------------------------------------
+
+class Histogram:
+	"""Counts of observations falling under each of a set of upper bounds, in 
+	the cumulative form Prometheus expects"""
+	BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5,
+			5, 10)
+	counts = None
+	count = 0
+	sum = 0
+
+	def __init__(self):
+		self.counts = [0] * len(self.BOUNDS)
+
+	def observe(self, value):
+		for i, bound in enumerate(self.BOUNDS):
+			if value <= bound:
+				self.counts[i] += 1
+		self.count += 1
+		self.sum += value
+
+class Metrics:
+	"""Counters, latency histograms and gauges describing what MPN has been 
+	doing, safe to update from any thread. Metrics are named without the mpn_ 
+	prefix, which is added when they are rendered."""
+	# help text for each metric, which also decides the order they're shown in
+	HELP = collections.OrderedDict((
+		("notify_latency_seconds", "Time from an MPD idle wake-up to the "
+				"notification being shown"),
+		("mpd_round_trip_seconds", "Time taken by commands sent to MPD"),
+		("cover_lookup_seconds", "Time taken to find a song's cover art file"),
+		("cover_lookups_abandoned_total", "Cover art lookups given up on "
+				"because the music path was slow to respond"),
+		("image_decode_seconds", "Time taken to decode cover art"),
+		("image_resize_seconds", "Time taken to resize cover art"),
+		("cache_requests_total", "Cache lookups, by cache and result"),
+		("notifications_total", "Notifications shown"),
+		("connection_attempts_total", "Attempts to connect to MPD, by result"),
+		("reconnects_total", "Connections to MPD which were lost"),
+		("resident_memory_bytes", "Resident set size of the process"),
+		("uptime_seconds", "Time since MPN started"),
+		))
+	lock = None
+	counters = None
+	histograms = None
+	gauges = None
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counters = collections.defaultdict(int)
+		self.histograms = collections.defaultdict(Histogram)
+		started = monotonic()
+		self.gauges = {
+			"resident_memory_bytes": resident_memory,
+			"uptime_seconds": lambda: monotonic() - started,
+			}
+
+	def count(self, name, n=1, **labels):
+		"""Add n to the counter name with the given labels"""
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.counters[key] += n
+
+	def observe(self, name, seconds, **labels):
+		"""Add a duration to the histogram name with the given labels"""
+		key = (name, tuple(sorted(labels.items())))
+		with self.lock:
+			self.histograms[key].observe(seconds)
+
+	@contextlib.contextmanager
+	def timer(self, name, **labels):
+		"""Observe how long the body of a with statement takes"""
+		start = monotonic()
+		try:
+			yield
+		finally:
+			self.observe(name, monotonic() - start, **labels)
+
+	def snapshot(self):
+		"""Return a dictionary of metric name to a list of (labels, value) 
+		pairs, where the value of a histogram is a dictionary of its bucket 
+		counts, count and sum"""
+		result = collections.defaultdict(list)
+		with self.lock:
+			for (name, labels), value in self.counters.iteritems():
+				result[name].append((dict(labels), value))
+			for (name, labels), histogram in self.histograms.iteritems():
+				result[name].append((dict(labels), {
+					"buckets": zip(histogram.BOUNDS, histogram.counts),
+					"count": histogram.count,
+					"sum": histogram.sum,
+					}))
+		for name, function in self.gauges.iteritems():
+			value = function()
+			if value is not None:
+				result[name].append(({}, value))
+		return result
+
+	def render_json(self):
+		"""Return the metrics as JSON"""
+		snapshot = self.snapshot()
+		return json.dumps(dict(("mpn_" + name,
+				[dict(labels=labels, value=value)
+						for labels, value in snapshot[name]])
+				for name in self.HELP if name in snapshot), indent=1)
+
+	def render_text(self):
+		"""Return the metrics in the Prometheus text exposition format"""
+		def series(name, labels, extra=()):
+			labels = sorted(labels.items()) + list(extra)
+			if not labels:
+				return name
+			return "%s{%s}" % (name, ",".join('%s="%s"' % (key,
+					str(value).replace("\\", "\\\\").replace('"', '\\"'))
+					for key, value in labels))
+
+		snapshot = self.snapshot()
+		lines = []
+		for name in self.HELP:
+			if name not in snapshot:
+				continue
+			full = "mpn_" + name
+			if name.endswith("_total"):
+				kind = "counter"
+			elif name in self.gauges:
+				kind = "gauge"
+			else:
+				kind = "histogram"
+			lines.append("# HELP %s %s" % (full, self.HELP[name]))
+			lines.append("# TYPE %s %s" % (full, kind))
+			for labels, value in sorted(snapshot[name]):
+				if kind != "histogram":
+					lines.append("%s %s" % (series(full, labels), value))
+					continue
+				for bound, count in value["buckets"]:
+					lines.append("%s %d" % (series(full + "_bucket", labels,
+							[("le", bound)]), count))
+				lines.append("%s %d" % (series(full + "_bucket", labels,
+						[("le", "+Inf")]), value["count"]))
+				lines.append("%s %s" % (series(full + "_sum", labels),
+						value["sum"]))
+				lines.append("%s %d" % (series(full + "_count", labels),
+						value["count"]))
+		return "\n".join(lines) + "\n"
+
+def resident_memory():
+	"""Return the resident set size of this process in bytes, or None if it 
+	can't be found"""
+	try:
+		with open("/proc/self/statm") as f:
+			return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+	except (IOError, ValueError, IndexError, OSError):
+		return None
+
+metrics = Metrics()
+
+# control socket
+# ------------------------------------------------------------------------------
+
+class ControlServer:
+	"""A Unix socket in the main loop taking one command per connection, as a 
+	line of words, and replying with whatever its handler returns before 
+	closing the connection. handler is called with the list of words and 
+	should return a string, or raise ValueError for a bad command."""
+	path = None
+	handler = None
+	socket = None
+	watch = None
+
+	def __init__(self, path, handler):
+		self.path = path
+		self.handler = handler
+		self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+		# create the socket private, rather than chmod it after binding and 
+		# leave a moment in which another user could connect
+		umask = os.umask(0077)
+		try:
+			self._bind()
+		except socket.error:
+			self.socket.close()
+			raise
+		finally:
+			os.umask(umask)
+		self.watch = gobject.io_add_watch(self.socket, gobject.IO_IN,
+				self.on_connection)
+
+	def _bind(self):
+		try:
+			self.socket.bind(self.path)
+		except socket.error, e:
+			if e.errno != errno.EADDRINUSE:
+				raise
+			# still in use, or left behind by an instance which died?
+			probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+			try:
+				probe.connect(self.path)
+			except socket.error:
+				os.unlink(self.path)
+				self.socket.bind(self.path)
+			else:
+				raise socket.error(errno.EADDRINUSE,
+						"another MPN is listening on %s" % self.path)
+			finally:
+				probe.close()
+		self.socket.listen(5)
+
+	def on_connection(self, *args, **kwargs):
+		try:
+			connection, address = self.socket.accept()
+		except socket.error:
+			return True
+		try:
+			# clients are local and send their one line straight away
+			connection.settimeout(1)
+			words = connection.makefile("r").readline().split()
+			try:
+				reply = self.handler(words)
+			except ValueError, e:
+				reply = "error: %s\n" % e
+			except Exception, e:
+				# returning anything but true would remove this watch, and
+				# leave clients waiting forever
+				traceback.print_exc()
+				reply = "error: %s\n" % e
+			connection.sendall(reply)
+		except socket.error:
+			pass
+		finally:
+			connection.close()
+		return True
+
+	def close(self):
+		gobject.source_remove(self.watch)
+		self.socket.close()
+		try:
+			os.unlink(self.path)
+		except OSError:
+			pass
+
+# shared resources
+# ------------------------------------------------------------------------------
+
+class Resources:
+	"""Everything shared by the notifiers in one process, one per MPD server: 
+	the caches of directory listings, cover art and images, the worker 
+	threads, and the list of notifiers themselves"""
+	notifiers = None
+	dircache = None
+	cover_matcher = None
+	cover_index = None
+	workers = None
+	images = None
+	thumbnails = None
+	embedded = None
+	remote = None
+	mount_guard = None
+	no_cover = None
+	control = None
+	config = None
+
+	# control socket commands carried out by calling a notifier's method
+	NOTIFIER_COMMANDS = {
+		"show": "on_activate",
+		"play": "play_cb",
+		"pause": "pause_cb",
+		"toggle": "toggle_cb",
+		"stop": "stop_cb",
+		"next": "next_cb",
+		"prev": "prev_cb",
+		"reconnect": "retry_now",
+		}
+
+	def __init__(self, options, config=None):
+		"""config is the dictionary of options read from the configuration 
+		file, which the options given default to"""
+		self.notifiers = []
+		self.config = config if config is not None else DEFAULT_OPTIONS
+
+		# keep rendered icons for later runs
+		try:
+			icons.directory = cache_directory("icons")
+		except OSError, e:
+			print "Failed to create icon cache directory: %s" % e
+
+		self.dircache = DirectoryCache(watch=not options.once)
+		self.cover_matcher = CoverMatcher(options.cover_names)
+		if options.cover_deadline:
+			self.mount_guard = MountGuard(options.cover_deadline / 1000.0)
+		self.no_cover = NegativeCache(options.missing_cover_ttl)
+		if options.cover_index and options.music_path and not options.once:
+			try:
+				self.cover_index = CoverIndex(
+						os.path.join(cache_directory(), "covers.sqlite"),
+						options.music_path, self.cover_matcher,
+						options.cover_parent_depth,
+						on_change=self.on_cover_index_changed)
+			except (sqlite3.Error, OSError), e:
+				print "Failed to open cover index: %s" % e
+		if options.image_threads and not options.once:
+			self.workers = WorkerPool(options.image_threads)
+		if options.image_cache_size:
+			self.images = ImageCache(options.image_cache_size * 1024 * 1024)
+		if options.thumbnail_cache_size:
+			try:
+				self.thumbnails = ThumbnailStore(cache_directory(),
+						options.thumbnail_cache_size * 1024 * 1024)
+			except (sqlite3.Error, EnvironmentError), e:
+				print "Failed to open thumbnail store: %s" % e
+		if options.embedded_covers and options.music_path:
+			try:
+				self.embedded = EmbeddedCovers(cache_directory("embedded"))
+			except (sqlite3.Error, EnvironmentError), e:
+				print "Failed to open embedded cover art cache: %s" % e
+		if options.remote_covers:
+			try:
+				self.remote = RemoteCovers(cache_directory("remote"))
+			except (sqlite3.Error, EnvironmentError), e:
+				print "Failed to open remote cover art cache: %s" % e
+
+	def on_cover_index_changed(self):
+		self.no_cover.clear()
+		for notifier in self.notifiers:
+			notifier.on_cover_index_changed()
+
+	def listen(self):
+		"""Start taking commands on the control socket"""
+		path = control_socket_path()
+		try:
+			if not os.path.isdir(os.path.dirname(path)):
+				os.makedirs(os.path.dirname(path))
+			self.control = ControlServer(path, self.handle_command)
+		except (socket.error, OSError), e:
+			print "Not listening for commands: %s" % e
+
+	def handle_command(self, words):
+		"""Reply to a command from the control socket, as sent by mpn ctl"""
+		command, arguments = (words or [None])[0], words[1:]
+		if command == "stats":
+			if arguments == ["json"]:
+				return metrics.render_json() + "\n"
+			if arguments in ([], ["text"]):
+				return metrics.render_text()
+		elif command == "notify":
+			if not arguments:
+				raise ValueError("nothing to say")
+			notify2.Notification("MPN", cgi.escape(" ".join(arguments))).show()
+			return "ok\n"
+		elif command == "reload-config":
+			self.reload_config()
+			return "ok\n"
+		elif command in self.NOTIFIER_COMMANDS:
+			notifiers = self.notifiers
+			if arguments:
+				name = " ".join(arguments)
+				notifiers = [notifier for notifier in notifiers
+						if notifier.name == name]
+				if not notifiers:
+					raise ValueError("no server named %s" % name)
+			if command != "reconnect":
+				notifiers = [notifier for notifier in notifiers
+						if notifier.state.status is not None]
+				if not notifiers:
+					raise ValueError("not connected")
+			refused = [notifier.name for notifier in notifiers
+					if getattr(notifier, self.NOTIFIER_COMMANDS[command])()
+							is False]
+			if refused:
+				raise ValueError("%s failed on %s"
+						% (command, ", ".join(refused)))
+			return "ok\n"
+		raise ValueError("unknown command: %s" % " ".join(words))
+
+	def reload_config(self):
+		"""Reread the configuration file and apply the RELOADABLE options from 
+		it, except where they were set on the command line or for a particular 
+		server. Raises ValueError if the file or the new formats are 
+		invalid."""
+		try:
+			config = load_config()
+		except (yaml.YAMLError, TypeError, ValueError), e:
+			raise ValueError("invalid configuration file: %s" % e)
+		for name in ("title_format", "body_format"):
+			try:
+				Template(config[name])
+			except ValueError, e:
+				raise ValueError("invalid %s setting: %s" % (name, e))
+		for notifier in self.notifiers:
+			changes = {}
+			for key in RELOADABLE:
+				if notifier.server is not None and key in notifier.server:
+					continue
+				if getattr(notifier.options, key) == self.config.get(key):
+					changes[key] = config[key]
+			notifier.reconfigure(changes)
+		self.config = config
+
+	def watch_network(self):
+		"""Have disconnected notifiers retry as soon as NetworkManager says the 
+		network is up, if D-Bus and NetworkManager are available. Return true 
+		if so."""
+		try:
+			import dbus
+			from dbus.mainloop.glib import DBusGMainLoop
+		except ImportError:
+			return False
+		try:
+			bus = dbus.SystemBus(mainloop=DBusGMainLoop())
+			bus.add_signal_receiver(self.on_network_state_changed,
+					signal_name="StateChanged",
+					dbus_interface="org.freedesktop.NetworkManager")
+		except dbus.DBusException:
+			return False
+		return True
+
+	def on_network_state_changed(self, state):
+		# NM_STATE_CONNECTED_LOCAL and above
+		if state >= 50:
+			for notifier in self.notifiers:
+				notifier.retry_now()
+
 # main class
 # ------------------------------------------------------------------------------
 
 class Notifier:
-	"Main class for mpn"
+	"Main class for mpn, one for each MPD server"
+	# milliseconds to hold a notification back waiting for its cover art
+	IMAGE_WAIT = 250
+	# seconds between connection attempts, doubling from the minimum
+	RETRY_MIN = 1
+	RETRY_MAX = 60
+	# the play states shown on the status icon
+	PLAY_STATES = ("disconnected", "stop", "play", "pause")
+	# number of status icon images with a play state drawn on to keep
+	STATUS_ICONS_KEPT = 8
+	# weight of each new measurement in the average MPD round trip time
+	RTT_WEIGHT = 0.2
+	# what to query when idle reports each subsystem changed
+	QUERIES = {
+			"player": ("status", "currentsong"),
+			"playlist": ("status", "currentsong"),
+			"mixer": ("status",),
+			"options": ("status",),
+			"update": ("status",),
+			}
+
 	options = None
+	server = None
+	name = None
+	resources = None
 	host = "localhost"
 	port = 6600
 	mpd = None
-	status = None
-	current = None
+	state = None
 	notifier = None
-	title_txt = None
-	body_txt = None
+	title_template = None
+	body_template = None
 	current_image_url = None
 	pixbuf_notification = None
 	pixbuf_statusicon = None
 	status_icon_size = None
-	re = {}
+	status_icon_cover = None
+	status_icons = None
 	menu = None
 	menu_reconnect = None
 	menu_play = None
@@ -324,9 +2560,38 @@ class Notifier:
 	menu_stop = None
 	menu_prev = None
 	menu_next = None
-	connection_timer = None
+	retry_timer = None
+	retry_delay = None
+	connector = None
+	connecting = None
 	connection_lock = None
 	watch = None
+	dircache = None
+	cover_matcher = None
+	cover_index = None
+	thumbnails = None
+	embedded = None
+	remote = None
+	picture_client = None
+	mount_guard = None
+	no_cover = None
+	images = None
+	workers = None
+	image_job = None
+	prefetch_job = None
+	prefetch_songid = None
+	prefetched = None
+	show_timer = None
+	woken = None
+	coalesce_timer = None
+	coalesce_pending = False
+	coalesce_show = False
+	notification_shown = False
+	rtt = None
+	clock = None
+	uses_clock = False
+	refresh_timer = None
+	idle_subsystems = None
 
 	# callbacks
 	# --------------------------------------------------------------------------
@@ -338,36 +2603,57 @@ class Notifier:
 			if not self.options.once:
 				try:
 					self.mpd.noidle()
-					self.mpd.fetch_idle()
+					changes = self.mpd.fetch_idle()
 				except (mpd.ConnectionError, mpd.socket.error):
 					if not self.reconnect():
 						return False
 					self.mpd.noidle()
-					self.mpd.fetch_idle()
-			command()
-			if self.options.once:
-				self.quit()
-			else:
-				self.mpd.send_idle("player")
+					changes = self.mpd.fetch_idle()
+				if changes:
+					# don't lose changes which happened just before
+					self.checkstate(changes)
+			try:
+				start = time.time()
+				command()
+				self.record_rtt(time.time() - start)
+			except mpd.CommandError, e:
+				# such as "next" while stopped
+				print "MPD refused %s: %s" \
+						% (getattr(command, "__name__", command), e)
+				return False
+			finally:
+				if self.options.once:
+					self.quit()
+				else:
+					try:
+						self.mpd.send_idle(*self.idle_subsystems)
+					except (mpd.ConnectionError, mpd.socket.error):
+						self.reconnect()
 			return True
 	def play_cb(self, *args, **kwargs):
-		self._mpd_command(self.mpd.play)
+		return self._mpd_command(self.mpd.play)
 	def pause_cb(self, *args, **kwargs):
-		self._mpd_command(self.mpd.pause)
+		return self._mpd_command(self.mpd.pause)
 	def stop_cb(self, *args, **kwargs):
-		self._mpd_command(self.mpd.stop)
+		return self._mpd_command(self.mpd.stop)
 	def prev_cb(self, *args, **kwargs):
-		self._mpd_command(self.mpd.previous)
+		return self._mpd_command(self.mpd.previous)
 	def next_cb(self, *args, **kwargs):
-		self._mpd_command(self.mpd.next)
+		return self._mpd_command(self.mpd.next)
+	def toggle_cb(self, *args, **kwargs):
+		if self.state.status is not None \
+				and self.state.status["state"] == "play":
+			return self.pause_cb()
+		return self.play_cb()
 
 	def reconnect_cb(self, *args, **kwargs):
-		with self.connection_lock:
-			self.connect()
+		self.retry_now()
 
 	def closed_cb(self, *args, **kwargs):
 		if self.options.debug:
 			print "Notification closed"
+		self.notification_shown = False
+		self.schedule_refresh()
 		if self.options.once:
 			self.quit()
 
@@ -376,23 +2662,31 @@ class Notifier:
 			return True
 		with self.connection_lock:
 			self.connection_lock.release()
+			self.woken = monotonic()
 			try:
 				try:
 					self.mpd.noidle()
-					self.mpd.fetch_idle()
+					changes = self.mpd.fetch_idle()
 				except mpd.PendingCommandError:
-					pass
-				self.checkstate()
-				self.mpd.send_idle("player")
+					changes = None
+				except mpd.CommandError, e:
+					# a subsystem this MPD doesn't know; rather than lose the 
+					# watch, fall back to the player alone
+					print "MPD refused to idle on %s: %s" \
+							% (",".join(self.idle_subsystems), e)
+					self.idle_subsystems = ("player",)
+					changes = None
+				self.checkstate(changes)
+				self.mpd.send_idle(*self.idle_subsystems)
 			except (mpd.ConnectionError, mpd.socket.error):
 				self.reconnect()
 			return True
 
 	def on_activate(self, *args, **kwargs):
 		"""Status icon was clicked"""
-		if self.status is not None \
-				and self.status["state"] in ["play", "pause"]:
-			self.notifier.show()
+		if self.state.status is not None \
+				and self.state.status["state"] in ["play", "pause"]:
+			self.show_notification()
 
 	def on_popup_menu(self, icon, button, time):
 		"""Status icon was right-clicked"""
@@ -404,6 +2698,12 @@ class Notifier:
 		"""Status icon's size changed"""
 		self.update()
 
+	def on_cover_index_changed(self):
+		"""A cover index scan changed some covers; the current one may be 
+		among them"""
+		with self.connection_lock:
+			self.update()
+
 	def show_about_dialog(self, widget):
 		"""About dialog requested"""
 		about_dialog = gtk.AboutDialog()
@@ -412,7 +2712,11 @@ class Notifier:
 		about_dialog.set_name("MPN")
 		about_dialog.set_version(VERSION)
 
-		about_dialog.set_logo(svg_to_pixbuf(make_svg("cd", 196)))
+		about_dialog.set_logo(icons.get("cd", 196))
+
+		if self.rtt is not None:
+			about_dialog.set_comments("Average MPD round trip: %.1fms"
+					% (self.rtt * 1000))
 
 		authors = []
 		for i, n in enumerate(AUTHOR.split(", ")):
@@ -426,23 +2730,37 @@ class Notifier:
 	# --------------------------------------------------------------------------
 
 	def get_host(self):
-		"""get host name from MPD_HOST env variable"""
+		"""get host name from the server setting or MPD_HOST env variable"""
+		if self.server is not None:
+			return self.server.get("host", "localhost")
 		host = os.environ.get("MPD_HOST", "localhost")
 		if "@" in host:
-			return host.split("@", 1)
+			return host.split("@", 1)[1]
 		return host
 
 	def get_port(self):
-		"""get host name from MPD_PORT env variable"""
+		"""get port from the server setting or MPD_PORT env variable"""
+		if self.server is not None:
+			return self.server.get("port", 6600)
 		return os.environ.get("MPD_PORT", 6600)
 
+	def get_password(self):
+		"""get password from the server setting or MPD_HOST env variable, or 
+		None if there isn't one"""
+		if self.server is not None:
+			return self.server.get("password")
+		host = os.environ.get("MPD_HOST", "localhost")
+		if "@" in host:
+			return host.split("@", 1)[0]
+		return None
+
 	# current status
 	# --------------------------------------------------------------------------
 
 	def get_title(self, safe=False):
 		"""Get the current song title"""
 		try:
-			title = self.current["title"]
+			title = self.state.current["title"]
 			#In case the file has a multi-title tag
 			if type(title) is list:
 				title = " - ".join(title)
@@ -457,10 +2775,30 @@ class Notifier:
 			return cgi.escape(title)
 		return title
 
+	def get_field(self, name):
+		"""Get the value of a field used in the notification formats"""
+		if name == "title":
+			return self.get_title()
+		if name == "duration":
+			return self.get_time()
+		if name == "file":
+			return self.get_file()
+		if name == "server":
+			return self.name
+		if name == "elapsed":
+			return convert_time(int(self.clock.elapsed()))
+		if name == "remaining":
+			remaining = self.clock.remaining()
+			return "" if remaining is None else convert_time(int(remaining))
+		if name == "progress":
+			progress = self.clock.progress()
+			return "" if progress is None else "%d%%" % (progress * 100)
+		return self.get_tag(name)
+
 	def get_time(self, elapsed=False):
 		"""Get current time and total length of the current song"""
 		try:
-			time = self.status["time"]
+			time = self.state.status["time"]
 			now, length = [int(c) for c in time.split(":")]
 			now_time = convert_time(now)
 			length_time = convert_time(length)
@@ -476,7 +2814,7 @@ class Notifier:
 	def get_tag(self, tag, safe=False):
 		"""Get a generic tag from the current data"""
 		try:
-			data = self.current[tag]
+			data = self.state.current[tag]
 			#In case the file has a multi-value tag
 			if type(data) is list:
 				data = " / ".join(data)
@@ -491,7 +2829,7 @@ class Notifier:
 	def get_file(self, safe=False):
 		"""Get the current song file"""
 		try:
-			file = self.current["file"]
+			file = self.state.current["file"]
 			# Remove left-side path
 			file = re.sub(".*"+os.sep, "", file)
 			# Remove right-side extension
@@ -508,6 +2846,9 @@ class Notifier:
 	# --------------------------------------------------------------------------
 
 	def connect(self):
+		"""Try to connect now, return true on success. On failure a retry is 
+		scheduled if persisting. This blocks for up to connect_timeout, so 
+		once the main loop is running use connect_in_background instead."""
 		# abort if we can't get a lock
 		if not self.connection_lock.acquire(False):
 			return False
@@ -517,43 +2858,152 @@ class Notifier:
 			# on returns later
 			self.connection_lock.release()
 
-			# cancel existing timer if there is one
-			if self.connection_timer is not None:
-				self.connection_timer.cancel()
-				self.connection_timer = None
+			# cancel any scheduled retry or attempt under way
+			if self.retry_timer is not None:
+				glib.source_remove(self.retry_timer)
+				self.retry_timer = None
+			if self.connecting is not None:
+				self.connecting.cancel()
+				self.connecting = None
 
 			# get host and port (environment could have changed)
 			host = self.get_host()
 			port = self.get_port()
 
 			try:
-				self.mpd.connect(self.get_host(), self.get_port())
+				client = self.open_connection(host, port)
+			except (mpd.socket.error, mpd.ConnectionError, mpd.CommandError), e:
+				return self.connection_failed(host, port, e)
+			return self.connected(client, host, port)
+
+	def connect_in_background(self):
+		"""Queue a connection attempt for this notifier's connector thread, 
+		which hands the result back to the main loop, so that an unreachable 
+		server doesn't freeze it for connect_timeout. Return false, there 
+		being no connection yet."""
+		if self.options.once:
+			return self.connect()
+		with self.connection_lock:
+			if self.connecting is not None:
+				return False
+			if self.retry_timer is not None:
+				glib.source_remove(self.retry_timer)
+				self.retry_timer = None
+			self.connecting = self.connector.submit(self.attempt_connection,
+					self.on_connect_attempt, self.get_host(), self.get_port())
+		return False
+
+	def attempt_connection(self, host, port):
+		"""Run by the connector thread, return the host, port, the client or 
+		None and the error or None"""
+		try:
+			return host, port, self.open_connection(host, port), None
+		except (mpd.socket.error, mpd.ConnectionError, mpd.CommandError), e:
+			return host, port, None, e
+
+	def on_connect_attempt(self, result):
+		host, port, client, error = result
+		with self.connection_lock:
+			self.connecting = None
+			if self.state.status is not None:
+				# connected some other way meanwhile
+				if client is not None:
+					client.disconnect()
+			elif client is not None:
+				self.connected(client, host, port)
+			else:
+				self.connection_failed(host, port, error)
+				if not self.options.persist:
+					self.quit(code=1)
+
+	def open_connection(self, host, port):
+		"""Return a new client connected to MPD and given the password. Raises 
+		socket.error, mpd.ConnectionError, or mpd.CommandError if the password 
+		is refused."""
+		client = mpd.MPDClient()
+		client.connect(host, port, timeout=self.options.connect_timeout or None)
+		password = self.get_password()
+		if password is not None:
+			try:
+				client.password(password)
+			except mpd.CommandError:
+				client.disconnect()
+				raise
+		return client
+
+	def connected(self, client, host, port):
+		"""Start using a newly connected client, return true on success"""
+		with self.connection_lock:
+			self.mpd = client
+			try:
 				if not self.options.once and self.watch is None:
 					self.watch = gobject.io_add_watch(
 							self.mpd, gobject.IO_IN, self.player_cb)
 				self.checkstate()
 				if not self.options.once:
-					self.mpd.send_idle("player")
-				return True
-			except mpd.socket.error:
-				print "Failed to connect to %s:%s (socket error)" % (host, port)
-			except mpd.ConnectionError:
-				print "Failed to connect to %s:%s (connection error)" % (host, port)
+					self.mpd.send_idle(*self.idle_subsystems)
+			except (mpd.socket.error, mpd.ConnectionError), e:
+				return self.connection_failed(host, port, e)
+			self.retry_delay = None
+			metrics.count("connection_attempts_total", server=self.name,
+					result="success")
+			return True
 
-			if not self.options.persist:
-				return False
+	def connection_failed(self, host, port, error):
+		"""Report a failed connection attempt and schedule a retry if 
+		persisting, return false"""
+		if isinstance(error, mpd.CommandError):
+			reason = "password refused"
+		elif isinstance(error, mpd.ConnectionError):
+			reason = "connection error"
+		else:
+			reason = "socket error"
+		print "Failed to connect to %s:%s (%s)" % (host, port, reason)
+		metrics.count("connection_attempts_total", server=self.name,
+				result="failure")
+		if self.options.persist and not self.options.once:
+			self.schedule_retry()
+		return False
 
-			if self.connection_timer is None:
-				self.connection_timer = threading.Timer(3, self.connect)
-				self.connection_timer.start()
-			return False
+	def schedule_retry(self):
+		"""Schedule another connection attempt in the main loop. The delay 
+		doubles with each failure up to RETRY_MAX seconds, and is jittered so 
+		that clients of a restarting server don't all retry at once."""
+		if self.retry_timer is not None:
+			return
+		if self.retry_delay is None:
+			self.retry_delay = self.RETRY_MIN
+		else:
+			self.retry_delay = min(self.retry_delay * 2, self.RETRY_MAX)
+		delay = self.retry_delay * random.uniform(0.5, 1)
+		if self.options.debug:
+			print "retrying connection in %.1fs" % delay
+		self.retry_timer = glib.timeout_add(int(delay * 1000),
+				self.on_retry_timer)
+
+	def on_retry_timer(self):
+		self.retry_timer = None
+		self.connect_in_background()
+		return False
+
+	def retry_now(self):
+		"""Retry connecting immediately if not connected, starting the backoff 
+		again"""
+		with self.connection_lock:
+			if self.state.status is not None or self.connecting is not None:
+				return
+			self.retry_delay = None
+			self.connect_in_background()
 
 	def disconnect(self):
 		with self.connection_lock:
+			if self.watch is not None:
+				gobject.source_remove(self.watch)
+				self.watch = None
 			try:
 				self.mpd.disconnect()
-				self.status = None
-				self.current = None
+				self.state.reset()
+				self.clock.sync(None)
 				self.update()
 				return True
 			except (mpd.socket.error, mpd.ConnectionError):
@@ -562,133 +3012,417 @@ class Notifier:
 	def reconnect(self):
 		with self.connection_lock:
 			# abort if there's already a connection attempt
-			if self.connection_timer is not None:
+			if self.retry_timer is not None or self.connecting is not None:
 				return False
 
+			metrics.count("reconnects_total", server=self.name)
 			self.disconnect()
 			if not self.options.persist:
 				print "Lost connection to server, exiting..."
 				self.quit(code=1)
-			tmp = self.connect()
-			return tmp
+			return self.connect_in_background()
 
 	# when idle calls back find out what changed
 	# --------------------------------------------------------------------------
 
-	def checkstate(self):
-		"""Check what has changed, take action"""
+	def checkstate(self, changes=None):
+		"""Check what has changed, take action. changes is the list of 
+		subsystems idle reported as changed, or None to check everything; only 
+		what they affect is queried."""
 		with self.connection_lock:
 			if self.options.debug:
-				print "checking state"
+				print "checking state, changes: %s" % changes
 
-			# get state
-			try:
-				status = self.mpd.status()
-				current = self.mpd.currentsong()
-			except (mpd.ConnectionError, socket.error):
-				return self.reconnect()
+			if changes is None:
+				queries = set(("status", "currentsong"))
+			else:
+				queries = set()
+				for subsystem in changes:
+					queries.update(self.QUERIES.get(subsystem, ()))
+
+			# get state, all in one round trip
+			status = None
+			current = None
+			if queries:
+				try:
+					start = time.time()
+					self.mpd.command_list_ok_begin()
+					if "status" in queries:
+						self.mpd.status()
+					if "currentsong" in queries:
+						self.mpd.currentsong()
+					results = self.mpd.command_list_end()
+					self.record_rtt(time.time() - start)
+				except (mpd.ConnectionError, socket.error):
+					return self.reconnect()
+				if "status" in queries:
+					status = results.pop(0)
+				if "currentsong" in queries:
+					current = results.pop(0)
 
 			# if in "once" mode and no song is playing, exit
-			if self.options.once and status["state"] == "stop":
+			if self.options.once and status is not None \
+					and status["state"] == "stop":
 				if self.options.debug:
 					print "Status is stopped, exiting"
 				sys.exit()
 
-			# has status changed
-			status_changed = self.status is None or \
-					status["state"] != self.status["state"]
-			oldstatus = self.status
-			self.status = status
-			if self.options.debug and status_changed:
-				print "status has changed: ", status
+			oldstatus = self.state.status
+			events = self.state.update(status, current)
+			if status is not None:
+				self.clock.sync(status)
+			if changes is not None:
+				events.update(e for e in ("database", "update") if e in changes)
+			if self.options.debug and events:
+				print "changed: %s" % ", ".join(sorted(events))
 
-			# has song changed
-			song_changed = self.current is None or current != self.current
-			self.current = current
-			if self.options.debug and song_changed:
-				print "song has changed: ", current
+			status_changed = "state" in events or "connection" in events
+			song_changed = "song" in events
+			status = self.state.status
 
 			# if stopped close the notification
 			if status["state"] == "stop":
 				self.close_notification()
 
-			# if anything important is different update icons, tooltip etc
-			if status_changed or song_changed:
-				self.update()
-
 			# if not stopped and the song changed, or was stopped and now not, 
 			# display the notification
-			if (oldstatus is None or oldstatus["state"] == "stop") \
+			show = (oldstatus is None or oldstatus["state"] == "stop") \
 					and status["state"] != "stop" \
-					or song_changed and status["state"] != "stop":
+					or song_changed and status["state"] != "stop"
+
+			if song_changed and self.coalescing():
+				# skipping quickly: only the song skipped to last matters
+				self.coalesce(show)
+			else:
+				# if anything important is different update icons, tooltip 
+				# etc
+				if status_changed or song_changed:
+					self.update()
+				if show:
+					self.show_notification()
+			if not show and self.show_timer is None \
+					and not self.coalesce_show:
+				# nothing to measure the wake-up against
+				self.woken = None
+
+			# start or stop ticking the times in the notification
+			if status is not None:
+				self.schedule_refresh()
+
+			# now let anything else interested know what changed
+			self.state.emit(*[e for e in MPDState.EVENTS if e in events])
+
+	def coalescing(self):
+		"""Return true if song changes are to be held back because another 
+		came shortly before, otherwise start the window in which following 
+		changes will be"""
+		if not self.options.coalesce or self.options.once:
+			return False
+		if self.coalesce_timer is not None:
+			return True
+		self.coalesce_timer = glib.timeout_add(self.options.coalesce,
+				self.on_coalesce_timer)
+		return False
+
+	def coalesce(self, show):
+		"""Hold back updating and showing the notification for a song change 
+		until the end of the coalescing window, restarting it, and drop any 
+		image work for songs since skipped"""
+		if self.options.debug:
+			print "coalescing song change"
+		self.coalesce_pending = True
+		self.coalesce_show = self.coalesce_show or show
+		if self.image_job is not None:
+			self.image_job.cancel()
+			self.image_job = None
+		glib.source_remove(self.coalesce_timer)
+		self.coalesce_timer = glib.timeout_add(self.options.coalesce,
+				self.on_coalesce_timer)
+
+	def on_coalesce_timer(self):
+		"""Nothing has changed for a while; catch up with the latest state"""
+		with self.connection_lock:
+			self.coalesce_timer = None
+			if not self.coalesce_pending:
+				return False
+			show = self.coalesce_show
+			self.coalesce_pending = False
+			self.coalesce_show = False
+			status = self.state.status
+			if status is None:
+				return False
+			self.update()
+			if show and status["state"] != "stop":
 				self.show_notification()
+		return False
+
+	def prefetch_next(self):
+		"""Ask a worker to prepare the next song's images when it has nothing 
+		more urgent to do. Called while the connection isn't idle, when the 
+		next song may have changed."""
+		status = self.state.status
+		if self.prefetch_job is not None:
+			self.prefetch_job.cancel()
+			self.prefetch_job = None
+		if status is None or status.get("nextsongid") == self.prefetch_songid:
+			return
+		self.prefetch_songid = status.get("nextsongid")
+		if self.prefetch_songid is None:
+			return
+		try:
+			songs = self.mpd.playlistid(self.prefetch_songid)
+		except mpd.CommandError:
+			return # the queue changed under us
+		if not songs or "file" not in songs[0]:
+			return
+		song = songs[0]
+		if self.prefetched is not None and self.prefetched[0] == song["file"]:
+			return
+		if self.options.debug:
+			print "prefetching images for %s" % song["file"]
+		si_size = None
+		if self.options.status_icon:
+			si_size = self.status_icon.get_size()
+		self.prefetch_job = self.workers.submit(self.make_images,
+				lambda result, file=song["file"]:
+						self.prefetch_ready(file, result),
+				song, False, None, None, si_size, priority=1)
+
+	def prefetch_ready(self, file, result):
+		"""Keep the next song's images until it starts"""
+		self.prefetched = (file, result)
+		self.prefetch_job = None
+
+	def record_rtt(self, seconds):
+		"""Record how long a round trip to MPD took"""
+		metrics.observe("mpd_round_trip_seconds", seconds, server=self.name)
+		if self.rtt is None:
+			self.rtt = seconds
+		else:
+			self.rtt += (seconds - self.rtt) * self.RTT_WEIGHT
+		if self.options.debug:
+			print "round trip: %.1fms (average %.1fms)" \
+					% (seconds * 1000, self.rtt * 1000)
+
+	def on_database_changed(self):
+		# cover art may have been added
+		self.no_cover.clear()
+		if self.cover_index is not None:
+			if self.options.debug:
+				print "database changed, rescanning cover index"
+			self.cover_index.rescan()
 
 	# show or close the notification
 	# --------------------------------------------------------------------------
 
 	def close_notification(self):
+		if self.show_timer is not None:
+			glib.source_remove(self.show_timer)
+			self.show_timer = None
+		self.notification_shown = False
+		self.schedule_refresh()
 		try:
 			self.notifier.close()
 		except glib.GError:
 			pass
 
 	def show_notification(self):
+		if self.image_job is not None:
+			# give the worker a moment to finish the cover art, so the 
+			# notification doesn't appear with the last song's
+			if self.show_timer is None:
+				self.show_timer = glib.timeout_add(self.IMAGE_WAIT,
+						self.on_image_wait_timeout)
+			return True
+		return self.show_notification_now()
+
+	def show_notification_now(self):
+		if self.show_timer is not None:
+			glib.source_remove(self.show_timer)
+			self.show_timer = None
 		if not self.notifier.show():
 			print "Impossible to display the notification"
 			return False
+		metrics.count("notifications_total", server=self.name)
+		if self.woken is not None:
+			metrics.observe("notify_latency_seconds", monotonic() - self.woken,
+					server=self.name)
+			self.woken = None
+		self.notification_shown = True
+		self.schedule_refresh()
 		return True
 
+	def on_image_wait_timeout(self):
+		"""The cover art took too long; show the notification with the 
+		placeholder, to be updated when the cover art is ready"""
+		with self.connection_lock:
+			self.show_timer = None
+			self.notifier.set_icon_from_pixbuf(
+					icons.get("cd", self.options.icon_size))
+			self.show_notification_now()
+		return False
+
 	# image manipulation
 	# --------------------------------------------------------------------------
 
-	def generate_notification_image(self):
-		def useCd():
-			self.pixbuf_notification = svg_to_pixbuf(
-					make_svg("cd", self.options.icon_size))
-
-		if self.current_image_url is None:
-			useCd()
-		else:
+	def cover_pixbuf(self, path, size, fast=False, alpha=False):
+		"""Return a pixbuf of the cover art at path resized to size, or None if 
+		it can't be loaded. If fast is true speed is favoured over quality when 
+		resizing. If alpha is true the pixbuf has an alpha channel, unless it 
+		comes from a thumbnail stored without one."""
+		try:
+			mtime = self.guarded_call(path, os.stat, path).st_mtime
+		except OSError:
+			return None
+		except MountUnresponsive, e:
+			metrics.count("cover_lookups_abandoned_total")
+			if self.options.debug:
+				print "gave up loading cover art: %s" % e
+			return None
+		if self.thumbnails is not None:
 			try:
-				self.pixbuf_notification = gtk.gdk.pixbuf_new_from_array(
-						numpy.array(Image.open(self.current_image_url).convert('RGB').resize(
-								(self.options.icon_size, self.options.icon_size),
-								Image.ANTIALIAS)),
-						gtk.gdk.COLORSPACE_RGB, 8)
-			except TypeError:
-				useCd()
-
-	def generate_status_image(self):
-		si_size = self.status_icon.get_size()
-		self.status_icon_size = si_size
-
-		if self.current_image_url is None:
-			si = svg_to_pixbuf(make_svg("cd", si_size))
-		else:
+				pixbuf = self.thumbnails.get(path, mtime, size)
+			except (sqlite3.Error, EnvironmentError), e:
+				print "Thumbnail lookup failed: %s" % e
+				pixbuf = None
+			metrics.count("cache_requests_total", cache="thumbnail",
+					result="miss" if pixbuf is None else "hit")
+			if pixbuf is not None:
+				return pixbuf
+
+		try:
+			image = self.source_image(path, mtime, size)
+			with metrics.timer("image_resize_seconds"):
+				if image.size != (size, size):
+					image = resize_image(image, size, fast)
+				if alpha:
+					image = image.convert("RGBA")
+			# tostring and pixbuf_new_from_data each copy the pixels once, 
+			# which is still cheaper than going through numpy
+			data = image.tostring()
+			width, height = image.size
+			rowstride = width * len(image.mode)
+			pixbuf = gtk.gdk.pixbuf_new_from_data(data, gtk.gdk.COLORSPACE_RGB,
+					alpha, 8, width, height, rowstride)
+		except (IOError, TypeError):
+			return None
+		except MountUnresponsive, e:
+			metrics.count("cover_lookups_abandoned_total")
+			if self.options.debug:
+				print "gave up loading cover art: %s" % e
+			return None
+
+		if self.thumbnails is not None:
 			try:
-				si = gtk.gdk.pixbuf_new_from_array(
-						numpy.array(Image.open(self.current_image_url).convert('RGB').resize(
-								(si_size, si_size), Image.ANTIALIAS)),
-						gtk.gdk.COLORSPACE_RGB, 8)
-			except TypeError:
-				si = svg_to_pixbuf(make_svg("cd", si_size))
+				self.thumbnails.put(path, mtime, size, data,
+						width, height, alpha, rowstride)
+			except (sqlite3.Error, EnvironmentError), e:
+				print "Failed to store thumbnail: %s" % e
+		return pixbuf
+
+	def source_image(self, path, mtime, size):
+		"""Return the decoded cover art at path, at least size pixels square 
+		unless the original is smaller. It is decoded only if the in-memory 
+		cache can't provide it, and then scaled down to the larger of size and 
+		the notification icon size before being cached."""
+		key = (path, mtime)
+		if self.images is not None:
+			image = self.images.get(key, size)
+			metrics.count("cache_requests_total", cache="image",
+					result="miss" if image is None else "hit")
+			if image is not None:
+				return image
+
+		needed = max(size, self.options.icon_size)
+		fast = self.options.notification_quality == "fast"
+		if self.options.status_icon and not self.options.once:
+			fast = fast and self.options.status_icon_quality == "fast"
+
+		with metrics.timer("image_decode_seconds"):
+			if self.guarded(path):
+				# read the file through the guard too, so a mount hanging 
+				# after the lookup can't block this worker for good
+				image = Image.open(StringIO.StringIO(
+						self.mount_guard.call(read_file, path)))
+			else:
+				image = Image.open(path)
+			complete = min(image.size) <= needed
+			if fast:
+				# let the JPEG decoder scale down by up to 8 via the DCT; the 
+				# result is still at least the size asked for
+				image.draft("RGB", (needed, needed))
+			image = image.convert('RGB')
+		if not complete:
+			with metrics.timer("image_resize_seconds"):
+				image = resize_image(image, needed, fast)
+
+		if self.images is not None:
+			self.images.put(key, image, complete)
+		return image
+
+	def guarded(self, path):
+		"""Return whether filesystem calls on path go through the mount 
+		guard, as they do under the music path"""
+		if self.mount_guard is None or self.options.music_path is None:
+			return False
+		return os.path.normpath(path).startswith(os.path.join(
+				os.path.normpath(self.options.music_path), ""))
+
+	def guarded_call(self, path, function, *args):
+		"""Return function(*args), through the mount guard if path is under 
+		the music path. Raises MountUnresponsive if the guard gives up."""
+		if self.guarded(path):
+			return self.mount_guard.call(function, *args)
+		return function(*args)
+
+	def generate_notification_image(self, coverpath):
+		"""Return the notification's pixbuf for the given cover art"""
+		pixbuf = None
+		if coverpath is not None:
+			pixbuf = self.cover_pixbuf(coverpath, self.options.icon_size,
+					self.options.notification_quality == "fast")
+		if pixbuf is None:
+			pixbuf = icons.get("cd", self.options.icon_size)
+		return pixbuf
+
+	def generate_status_image(self, coverpath, si_size):
+		"""Return the status icon's pixbuf, with an alpha channel, for the 
+		given cover art and size. The play state is drawn over it later by 
+		status_icon_pixbuf."""
+		si = None
+		if coverpath is not None:
+			si = self.cover_pixbuf(coverpath, si_size,
+					self.options.status_icon_quality == "fast", alpha=True)
+		if si is None:
+			si = icons.get("cd", si_size)
 
 		if not si.get_has_alpha():
 			si = si.add_alpha(True, 0, 0, 0)
-
-		self.pixbuf_statusicon = {}
-		p_size = int(round(si_size * self.options.play_state_icon_size))
-		for name in ("disconnected", "stop", "play", "pause"):
-			self.pixbuf_statusicon[name] = si.copy()
+		return si
+
+	def status_icon_pixbuf(self, state):
+		"""Return the status icon's pixbuf with the icon for the given play 
+		state drawn over it. They are composited when first needed and the 
+		last few kept, so switching between states is cheap."""
+		key = (self.status_icon_cover, self.status_icon_size, state)
+		pixbuf = self.status_icons.pop(key, None)
+		if pixbuf is None:
+			si = self.pixbuf_statusicon
+			si_size = self.status_icon_size
+			p_size = int(round(si_size * self.options.play_state_icon_size))
 			if p_size == 0:
-				continue
-
-			p = svg_to_pixbuf(make_svg(name, p_size))
-			p.composite(self.pixbuf_statusicon[name],
-					si_size - p_size, si_size - p_size,
-					p_size, p_size,
-					si_size - p_size, si_size - p_size,
-					1, 1, gtk.gdk.INTERP_NEAREST, 255)
+				pixbuf = si
+			else:
+				pixbuf = si.copy()
+				icons.get(state, p_size).composite(pixbuf,
+						si_size - p_size, si_size - p_size,
+						p_size, p_size,
+						si_size - p_size, si_size - p_size,
+						1, 1, gtk.gdk.INTERP_NEAREST, 255)
+		self.status_icons[key] = pixbuf
+		while len(self.status_icons) > self.STATUS_ICONS_KEPT:
+			self.status_icons.popitem(last=False)
+		return pixbuf
 
 	# take action when something we care about has changed
 	# --------------------------------------------------------------------------
@@ -697,42 +3431,16 @@ class Notifier:
 		"""Something we care about has changed -- take necessary actions. This 
 		method does not talk to MPD but rather relies on information already 
 		gathered"""
-		if self.current is None:
-			title = "Disconnected"
-			body = "Not currently connected to MPD"
-		elif "file" not in self.current:
-			title = "No song"
-			body = "No song is currently playing"
-		else:
-			title = self.title_txt
-			body = self.body_txt
-
-			# perform placeholder substitutions on title and body
-			for x in self.re.itervalues():
-				if len(x) < 3:
-					args = ()
-				else:
-					args = x[2]
-				title = x[0].sub(x[1](*args), title)
-				body = x[0].sub(x[1](*args), body)
+		title, body = self.render_text()
 
 		# show title and body for debug
 		if self.options.debug:
 			print "Title string: " + title
 			print "Body string: " + body
 
-		if self.status is None:
-			state = "disconnected"
-		else:
-			state = self.status["state"]
-
 		if self.options.status_icon and not self.options.once:
-			# update tooltip
-			if self.status is None:
-				self.status_icon.set_tooltip("Not connected")
-			else:
-				self.status_icon.set_tooltip(re.sub("<.*?>", "", "%s\n%s\n(%s)"
-						% (title, body, state)))
+			# the tooltip is rendered when it's shown; just say it changed
+			gtk.tooltip_trigger_tooltip_query(gtk.gdk.display_get_default())
 
 			# update menu
 			self.update_menu()
@@ -740,61 +3448,238 @@ class Notifier:
 		# update notification text
 		self.notifier.update(title, body)
 
-		# update images
-		images_changed = self.regenerate_images_if_necessary()
-
-		# update notification icon
-		if images_changed:
-			self.notifier.set_icon_from_pixbuf(self.pixbuf_notification)
+		# update images; unless in once mode this is done by a worker and 
+		# images_ready takes over when it's done
+		self.regenerate_images_if_necessary()
 
 		# update status icon (not only when images changed -- play state may 
 		# have changed)
-		if self.options.status_icon and not self.options.once:
-			if self.options.debug:
-				print "setting icon, state %s" % state
-			self.status_icon.set_from_pixbuf(self.pixbuf_statusicon[state])
-
-	def regenerate_images_if_necessary(self):
-		"""Regenerate images for notification and status icon if necessary, 
-		return true if anything changed"""
-
-		coverpath = None
-		if self.current is not None and \
-				"file" in self.current and self.options.music_path is not None:
-			dirname = os.path.dirname(
-					os.path.join(self.options.music_path, self.current["file"]))
-			for f in possible_cover_filenames():
-				f = fileexists_insensitive(os.path.join(dirname, f))
-				if f:
-					coverpath = f
-					break
-
-		generate_notification = False
-		generate_status = False
+		self.update_status_icon()
+
+	def render_text(self, escape=True):
+		"""Return the notification's title and body. Fields in the body are 
+		escaped for markup unless escape is false."""
+		if self.state.current is None:
+			return "Disconnected", "Not currently connected to MPD"
+		if "file" not in self.state.current:
+			return "No song", "No song is currently playing"
+		# share field values between the formats
+		cache = {}
+		title = self.title_template.render(self.get_field, cache=cache)
+		body = self.body_template.render(self.get_field, escape=escape,
+				cache=cache)
+		return title, body
+
+	def on_query_tooltip(self, icon, x, y, keyboard_mode, tooltip):
+		"""The status icon's tooltip is about to be shown; render it now so 
+		the times in it are current"""
+		if self.state.status is None:
+			text = "Not connected"
+		else:
+			title, body = self.render_text(escape=False)
+			text = re.sub("<.*?>", "", "%s\n%s\n(%s)"
+					% (title, body, self.state.status["state"]))
+		if len(self.resources.notifiers) > 1:
+			text = "%s: %s" % (self.name, text)
+		tooltip.set_text(text)
+		return True
 
-		if self.pixbuf_notification is None \
-				or coverpath != self.current_image_url:
-			generate_notification = True
-			generate_status = True
-		if self.options.status_icon and not self.options.once and \
-				self.status_icon_size != self.status_icon.get_size():
-			generate_status = True
-		if not self.options.status_icon or self.options.once:
-			generate_status = False
+	def schedule_refresh(self):
+		"""Keep the times in a notification which stays on screen up to date. 
+		A single timer ticks as the elapsed time reaches each whole second, 
+		and only runs while such a notification is shown and the song is 
+		playing and its format uses the times."""
+		if self.refresh_timer is not None:
+			glib.source_remove(self.refresh_timer)
+			self.refresh_timer = None
+		if self.options.timeout != 0 or not self.notification_shown \
+				or not self.uses_clock:
+			return
+		delay = self.clock.next_tick()
+		if delay is None:
+			return
+		self.refresh_timer = glib.timeout_add(int(delay * 1000) + 1,
+				self.on_refresh_timer)
+
+	def on_refresh_timer(self):
+		with self.connection_lock:
+			self.refresh_timer = None
+			if self.notification_shown:
+				self.notifier.update(*self.render_text())
+				self.notifier.show()
+				self.schedule_refresh()
+		return False
 
-		self.current_image_url = coverpath
+	def update_status_icon(self):
+		"""Show the status icon image for the current play state"""
+		if not self.options.status_icon or self.options.once \
+				or self.pixbuf_statusicon is None:
+			return
+		state = "disconnected" if self.state.status is None \
+				else self.state.status["state"]
+		if self.options.debug:
+			print "setting icon, state %s" % state
+		self.status_icon.set_from_pixbuf(self.status_icon_pixbuf(state))
 
+	def regenerate_images_if_necessary(self):
+		"""Regenerate images for notification and status icon if necessary. In 
+		once mode (or with no image threads) this is done immediately, 
+		otherwise a worker is asked to do it and any request still waiting 
+		from earlier is cancelled."""
+		si_size = None
+		if self.options.status_icon and not self.options.once:
+			si_size = self.status_icon.get_size()
+		args = (self.state.current, self.pixbuf_notification is not None,
+				self.current_image_url, self.status_icon_size, si_size)
+
+		if self.image_job is not None:
+			self.image_job.cancel()
+			self.image_job = None
+
+		# use the images prepared in advance if this is the song they were for
+		if self.prefetched is not None and self.state.current is not None \
+				and self.prefetched[0] == self.state.current.get("file") \
+				and self.prefetched[1][3] == si_size:
+			if self.options.debug:
+				print "using prefetched images"
+			result = self.prefetched[1]
+			self.prefetched = None
+			self.images_ready(result)
+			return
+
+		if self.workers is None:
+			self.images_ready(self.make_images(*args))
+		else:
+			self.image_job = self.workers.submit(self.make_images,
+					self.images_ready, *args)
+
+	def make_images(self, song, have_images, old_coverpath, old_si_size,
+			si_size):
+		"""Find the cover art for a song and generate whichever images need 
+		to change given what was used before. Return a tuple of the cover path, 
+		the notification pixbuf, the status icon pixbuf (without its play 
+		state) and the status icon size, with None for the images which don't 
+		need to change. This doesn't touch any widgets so can be run by a worker."""
+		coverpath = self.find_cover(song)
+
+		generate_notification = not have_images or coverpath != old_coverpath
+		generate_status = si_size is not None \
+				and (generate_notification or si_size != old_si_size)
+
+		pixbuf_notification = None
+		pixbuf_statusicon = None
 		if generate_notification:
-			self.generate_notification_image()
+			self.check_cancelled()
+			pixbuf_notification = self.generate_notification_image(coverpath)
 		if generate_status:
-			self.generate_status_image()
+			self.check_cancelled()
+			pixbuf_statusicon = self.generate_status_image(coverpath, si_size)
+		return coverpath, pixbuf_notification, pixbuf_statusicon, si_size
+
+	def check_cancelled(self):
+		"""Give up on the image job running in this thread, if any, if it has 
+		been cancelled"""
+		if self.workers is not None:
+			self.workers.check_cancelled()
+
+	def images_ready(self, result):
+		"""Install images generated by make_images"""
+		with self.connection_lock:
+			self.image_job = None
+			coverpath, pixbuf_notification, pixbuf_statusicon, si_size = result
+			self.current_image_url = coverpath
+
+			if pixbuf_notification is not None:
+				self.pixbuf_notification = pixbuf_notification
+				self.notifier.set_icon_from_pixbuf(pixbuf_notification)
+			if self.show_timer is not None:
+				# a notification was waiting for this image
+				self.show_notification_now()
+			elif pixbuf_notification is not None and self.notification_shown \
+					and not self.options.once:
+				# update the notification already on screen
+				self.show_notification_now()
+
+			if pixbuf_statusicon is not None:
+				self.pixbuf_statusicon = pixbuf_statusicon
+				self.status_icon_size = si_size
+				self.status_icon_cover = coverpath
+				# the file may have changed since these were composited
+				for state in self.PLAY_STATES:
+					self.status_icons.pop((coverpath, si_size, state), None)
+				self.update_status_icon()
+		return False
 
-		return generate_notification or generate_status
+	def find_cover(self, song):
+		"""Find the cover art file for a song, return its path or None"""
+		if song is None or "file" not in song or "://" in song["file"]:
+			return None
+		with metrics.timer("cover_lookup_seconds"):
+			coverpath = None
+			local = False
+			if self.options.music_path is not None:
+				path = os.path.join(self.options.music_path, song["file"])
+				# with embedded art each song may differ from its neighbours
+				missing = path if self.embedded is not None \
+						else os.path.dirname(path)
+				if missing in self.no_cover:
+					return None
+				try:
+					if self.mount_guard is None:
+						local, coverpath = self.find_local_cover(song)
+					else:
+						local, coverpath = self.mount_guard.call(
+								self.find_local_cover, song)
+				except MountUnresponsive, e:
+					metrics.count("cover_lookups_abandoned_total")
+					if self.options.debug:
+						print "gave up looking for cover art: %s" % e
+				else:
+					if coverpath is None and local:
+						self.no_cover.add(missing)
+			if coverpath is None and not local and self.remote is not None:
+				# the music isn't here; ask MPD for it
+				try:
+					coverpath = self.remote.find(self.picture_client,
+							self.name, song["file"])
+				except (socket.error, ValueError), e:
+					print "Failed to fetch cover art from %s: %s" \
+							% (self.name, e)
+			return coverpath
+
+	def find_local_cover(self, song):
+		"""Look for a song's cover art under the music path. Return whether 
+		the song is there and the cover's path or None."""
+		path = os.path.join(self.options.music_path, song["file"])
+		local = os.path.exists(path)
+		coverpath = self._find_cover(song)
+		if coverpath is None and local and self.embedded is not None:
+			coverpath = self.embedded.find(path)
+		return local, coverpath
+
+	def _find_cover(self, song):
+		dirname = os.path.dirname(
+				os.path.join(self.options.music_path, song["file"]))
+		if self.cover_index is not None:
+			try:
+				coverpath = self.cover_index.lookup(dirname)
+				metrics.count("cache_requests_total", cache="cover_index",
+						result="hit")
+				return coverpath
+			except KeyError:
+				# not indexed yet
+				metrics.count("cache_requests_total", cache="cover_index",
+						result="miss")
+			except sqlite3.Error, e:
+				print "Cover index lookup failed: %s" % e
+		return self.cover_matcher.find(dirname, self.dircache,
+				depth=self.options.cover_parent_depth,
+				root=self.options.music_path)
 
 	def update_menu(self):
 		"""Activate/deactivate buttons in the menu depending on connection and 
 		play state"""
-		if self.status is None:
+		if self.state.status is None:
 			for b in (self.menu_pause, self.menu_play, self.menu_stop, 
 					self.menu_prev, self.menu_next):
 				b.set_sensitive(False)
@@ -804,59 +3689,126 @@ class Notifier:
 			self.menu_prev.set_sensitive(True)
 			self.menu_next.set_sensitive(True)
 
-			playing = self.status["state"] == "play"
+			playing = self.state.status["state"] == "play"
 			self.menu_pause.set_sensitive(playing)
 			self.menu_play.set_sensitive(not playing)
 
-			self.menu_stop.set_sensitive(self.status["state"] != "stop")
+			self.menu_stop.set_sensitive(self.state.status["state"] != "stop")
+
+	# notification settings
+	# --------------------------------------------------------------------------
+
+	def configure_notification(self):
+		"""Set up the notification's timeout and formats from the options"""
+		# param timeout is in seconds
+		if self.options.timeout == 0:
+			self.notifier.set_timeout(notify2.EXPIRES_NEVER)
+		else:
+			self.notifier.set_timeout(1000 * self.options.timeout)
+
+		self.title_template = Template(
+				re.sub("<br>", "\n", self.options.title_format))
+		self.body_template = Template(
+				re.sub("<br>", "\n", self.options.body_format))
+		self.uses_clock = bool((self.title_template.fields
+				| self.body_template.fields)
+				& set(("elapsed", "remaining", "progress")))
+
+		if self.options.debug:
+			print "Title format: " + self.title_template.format
+			print "Body format: " + self.body_template.format
+
+	def reconfigure(self, changes):
+		"""Apply a dictionary of new values for the RELOADABLE options"""
+		for key, value in changes.iteritems():
+			setattr(self.options, key, value)
+		self.configure_notification()
+		if self.state.status is not None:
+			self.update()
+			self.schedule_refresh()
+
+	def on_queue_changed(self):
+		# the song's position can change without the song changing
+		if "pos" in self.title_template.fields \
+				or "pos" in self.body_template.fields:
+			self.update()
 
 	# start and stop MPN
 	# --------------------------------------------------------------------------
 
 	def run(self):
-		"""Connect and launch the first iteration"""
-		if not self.connect() \
-				and (not self.options.persist or self.options.once):
-			self.quit(code=1)
+		"""Connect and launch the first iteration, for every notifier sharing 
+		our resources"""
+		notifiers = self.resources.notifiers
 		# We only need the main loop when iterating or if keys are enabled
-		if self.options.keys or not self.options.once:
+		main_loop = self.options.keys or not self.options.once
+		if main_loop:
+			# before connecting, since workers may then call back
 			gtk.gdk.threads_init()
+		for notifier in notifiers:
+			if notifier.options.once:
+				if not notifier.connect():
+					self.quit(code=1)
+			else:
+				# one unreachable server mustn't hold up the others, or the 
+				# main loop
+				notifier.connect_in_background()
+		if main_loop:
+			if self.cover_index is not None:
+				self.cover_index.rescan()
+			if self.options.persist:
+				self.resources.watch_network()
+			if not self.options.once:
+				self.resources.listen()
 			gtk.main()
 
-	def quit(self, *args, **kwargs):
-		"""Shut down cleanly"""
+	def shutdown(self):
+		"""Close this notifier's notification and connection"""
 		if not self.options.once:
 			self.close_notification()
 		self.disconnect()
-		if self.connection_timer is not None:
-			self.connection_timer.cancel()
+		if self.picture_client is not None:
+			self.picture_client.close()
+		if self.retry_timer is not None:
+			glib.source_remove(self.retry_timer)
+			self.retry_timer = None
+		if self.connecting is not None:
+			self.connecting.cancel()
+			self.connecting = None
+		if self.coalesce_timer is not None:
+			glib.source_remove(self.coalesce_timer)
+			self.coalesce_timer = None
+
+	def quit(self, *args, **kwargs):
+		"""Shut down every notifier cleanly and exit"""
+		for notifier in self.resources.notifiers:
+			notifier.shutdown()
+		if self.resources.control is not None:
+			self.resources.control.close()
+			self.resources.control = None
 		try:
 			gtk.main_quit()
 		except RuntimeError:
 			pass # main wasn't running yet
-		try:
-			code = kwargs.code
-		except AttributeError:
-			code = 0
-		sys.exit(code)
+		sys.exit(kwargs.get("code", 0))
 
 	# initialize MPN
 	# --------------------------------------------------------------------------
 
-	def __init__(self, options):
-		"""Initialisation of mpd client and notify2"""
+	def __init__(self, options, resources=None, server=None):
+		"""Initialisation of mpd client and notify2. resources are those 
+		shared with other notifiers in this process, if any. server is a 
+		mapping from the servers setting giving the server to connect to, 
+		otherwise the environment says."""
 		self.options = options
-
-		# regular expressions
-		self.re = {
-				"t": (re.compile("(%t)", re.S), self.get_title),
-				"a": (re.compile("(%a)", re.S), self.get_tag, ("artist",)),
-				"b": (re.compile("(%b)", re.S), self.get_tag, ("album",)),
-				"d": (re.compile("(%d)", re.S), self.get_time),
-				"f": (re.compile("(%f)", re.S), self.get_file),
-				"n": (re.compile("(%n)", re.S), self.get_tag, ("track",)),
-				"p": (re.compile("(%p)", re.S), self.get_tag, ("pos",)),
-				}
+		self.server = server
+		if resources is None:
+			resources = Resources(options)
+		self.resources = resources
+		if server is not None and "name" in server:
+			self.name = server["name"]
+		else:
+			self.name = "%s:%s" % (self.get_host(), self.get_port())
 
 		# Contents are updated before displaying
 		self.notifier = notify2.Notification("MPN")
@@ -872,8 +3824,9 @@ class Notifier:
 			self.status_icon.connect("size_changed",
 					self.on_status_icon_size_changed)
 			self.status_icon.set_from_pixbuf(
-					svg_to_pixbuf(make_svg("cd", self.status_icon.get_size())))
+					icons.get("cd", self.status_icon.get_size()))
 			self.status_icon.set_tooltip("MPN")
+			self.status_icon.connect("query-tooltip", self.on_query_tooltip)
 			self.status_icon.set_visible(True)
 
 			# popup menu
@@ -926,49 +3879,62 @@ class Notifier:
 			if not self.options.persist:
 				self.menu_reconnect.hide()
 
-		# param timeout is in seconds
-		if self.options.timeout == 0:
-			self.notifier.set_timeout(notify2.EXPIRES_NEVER)
-		else:
-			self.notifier.set_timeout(1000 * self.options.timeout)
-
 		if self.options.keys:
 			self.notifier.add_action("back", "<", self.prev_cb)
 			self.notifier.add_action("forward", ">", self.next_cb)
 
-		self.title_txt = re.sub("<br>", "\n", self.options.title_format)
-		self.body_txt = re.sub("<br>", "\n", self.options.body_format)
-
-		if self.options.debug:
-			print "Title format: " + self.title_txt
-			print "Body format: " + self.body_txt
+		self.configure_notification()
 		self.mpd = mpd.MPDClient()
+		if not self.options.once:
+			# one long-lived thread for this server's connection attempts
+			self.connector = WorkerPool(1, "connect %s" % self.name)
+		self.state = MPDState()
+		self.clock = PlaybackClock()
+		self.status_icons = collections.OrderedDict()
+		self.idle_subsystems = tuple(set(["player"]
+				+ list(self.options.idle_subsystems)))
+
+		self.dircache = resources.dircache
+		self.cover_matcher = resources.cover_matcher
+		self.cover_index = resources.cover_index
+		self.workers = resources.workers
+		self.images = resources.images
+		self.thumbnails = resources.thumbnails
+		self.embedded = resources.embedded
+		self.remote = resources.remote
+		self.mount_guard = resources.mount_guard
+		self.no_cover = resources.no_cover
+		if self.remote is not None:
+			self.picture_client = PictureClient(self.get_host(),
+					self.get_port(), self.get_password(),
+					self.options.connect_timeout or None)
+		self.state.connect("database", self.on_database_changed)
+		self.state.connect("update", self.on_database_changed)
+
+		if self.options.prefetch and self.workers is not None:
+			for event in ("song", "queue", "options"):
+				self.state.connect(event, self.prefetch_next)
+		self.state.connect("queue", self.on_queue_changed)
 
 		if not self.options.once:
 			def handle_signal_usr1(*args, **kwargs):
-				self.on_activate()
+				for notifier in self.resources.notifiers:
+					notifier.on_activate()
 			signal.signal(signal.SIGUSR1, handle_signal_usr1)
 
 		self.connection_lock = threading.RLock()
+		self.resources.notifiers.append(self)
 
 # application class
 # ------------------------------------------------------------------------------
 
 class Application:
 	def run(self):
-		default_options = {}
-		default_options.update(DEFAULT_OPTIONS)
-		try:
-			stream = file(os.path.expanduser("~/.mpnrc"), "r")
-			default_options.update(yaml.load(stream))
-			stream.close()
-		except IOError:
-			try:
-				stream = file("mpnrc", "r")
-				default_options.update(yaml.load(stream))
-				stream.close()
-			except IOError:
-				pass
+		# talk to a running MPN, before doing anything slow
+		if sys.argv[1:2] == ["ctl"]:
+			sys.exit(mpnctl.main(sys.argv[2:]))
+
+		default_options = load_config()
 
 		# initializate the argument parser
 		parser = optparse.OptionParser(version="%prog " + VERSION, 
@@ -976,9 +3942,10 @@ class Application:
 				epilog="Defaults shown are after the influence of any "
 						"configuration file. Negative options exist for each "
 						"of the booleans starting with \"--no-\", for instance "
-						"--no-status-icon. Send the USR1 signal to a running "
-						"MPN process to display a notification, for instance "
-						"from a keyboard shortcut.")
+						"--no-status-icon. Run \"%prog ctl help\" for the "
+						"commands a running MPN takes, for instance from "
+						"keyboard shortcuts; sending it the USR1 signal also "
+						"displays a notification.")
 
 		def d(option):
 			return "(default: %sset)" % \
@@ -987,6 +3954,12 @@ class Application:
 		parser.add_option("--show-defaults", action="store_true",
 				help="Dump YAML of the default options, suitable for use as "
 						"a ~/.mpnrc file, and exit")
+		parser.add_option("--stats", action="store_const", const="text",
+				help="Print the running MPN's metrics in the Prometheus text "
+						"format and exit")
+		parser.add_option("--stats-json", dest="stats", action="store_const",
+				const="json", help="Print the running MPN's metrics as JSON "
+						"and exit")
 		parser.add_option("--debug", action="store_true", 
 				default=default_options["debug"],
 				help="Turn on debugging information %s" % d("debug"))
@@ -1008,6 +3981,20 @@ class Application:
 				raise optparse.OptionValueError("Timeout should be zero or a "
 						"positive integer")
 			parser.values.timeout = value
+		def set_connect_timeout(option, opt_str, value, parser):
+			value = float(value)
+			if value < 0:
+				raise optparse.OptionValueError("Connection timeout should be "
+						"zero or a positive number")
+			parser.values.connect_timeout = value
+		parser.add_option("--connect-timeout", type="float", metavar="SECS",
+				action="callback", callback=set_connect_timeout,
+				default=default_options["connect_timeout"],
+				help="Give up connecting to MPD after this long, and give up "
+						"on MPD if it takes this long to answer (default "
+						"%default, use 0 to wait forever). Failed connections "
+						"are retried in the background after a delay doubling "
+						"from 1 second to a minute.")
 		parser.add_option("-t", "--timeout", type="int", metavar="SECS", 
 				action="callback", callback=set_timeout, 
 				default=default_options["timeout"],
@@ -1047,6 +4034,150 @@ class Application:
 				default=default_options["music_path"],
 				help="Path to music files, where album art will be looked for "
 						"(default: %default, use empty string to disable)")
+		def set_cover_parent_depth(option, opt_str, value, parser):
+			value = int(value)
+			if value < 0:
+				raise optparse.OptionValueError("Cover parent depth should be "
+						"zero or a positive integer")
+			parser.values.cover_parent_depth = value
+		parser.add_option("--cover-parent-depth", type="int", metavar="LEVELS",
+				action="callback", callback=set_cover_parent_depth,
+				default=default_options["cover_parent_depth"],
+				help="Number of parent directories to also search for album "
+						"art, for instance 1 to find Album/cover.jpg for "
+						"Album/CD1/track.flac (default: %default)")
+		parser.add_option("--cover-index", action="store_true",
+				default=default_options["cover_index"],
+				help="Keep an index of album art in the cache directory, "
+						"built in the background and updated when MPD's "
+						"database changes, so finding album art doesn't touch "
+						"the music path %s" % d("cover_index"))
+		parser.add_option("--no-cover-index", dest="cover_index",
+				action="store_false", help=optparse.SUPPRESS_HELP)
+		def set_cover_deadline(option, opt_str, value, parser):
+			value = int(value)
+			if value < 0:
+				raise optparse.OptionValueError("Cover deadline should be "
+						"zero or a positive integer")
+			parser.values.cover_deadline = value
+		parser.add_option("--cover-deadline", type="int", metavar="MS",
+				action="callback", callback=set_cover_deadline,
+				default=default_options["cover_deadline"],
+				help="Give up looking for album art under the music path "
+						"after this long, and don't look there again until "
+						"the slow lookup finishes, so a hung network mount "
+						"can't hold up MPN; loading the art found is bounded "
+						"the same way (default: %default, use 0 to wait as "
+						"long as it takes)")
+		def set_missing_cover_ttl(option, opt_str, value, parser):
+			value = int(value)
+			if value < 0:
+				raise optparse.OptionValueError("Missing cover time should "
+						"be zero or a positive integer")
+			parser.values.missing_cover_ttl = value
+		parser.add_option("--missing-cover-ttl", type="int", metavar="SECS",
+				action="callback", callback=set_missing_cover_ttl,
+				default=default_options["missing_cover_ttl"],
+				help="Don't look again for album art in a directory (or with "
+						"--embedded-covers, for a song) which had none for "
+						"this long, unless MPD's database changes (default: "
+						"%default)")
+		parser.add_option("--embedded-covers", action="store_true",
+				default=default_options["embedded_covers"],
+				help="Use album art embedded in MP3, FLAC and MP4 files when "
+						"there's no image file, extracted once into the cache "
+						"directory %s" % d("embedded_covers"))
+		parser.add_option("--no-embedded-covers", dest="embedded_covers",
+				action="store_false", help=optparse.SUPPRESS_HELP)
+		parser.add_option("--remote-covers", action="store_true",
+				default=default_options["remote_covers"],
+				help="Fetch album art from MPD itself, over a second "
+						"connection, for songs not found under the music "
+						"path, keeping it in the cache directory %s"
+						% d("remote_covers"))
+		parser.add_option("--no-remote-covers", dest="remote_covers",
+				action="store_false", help=optparse.SUPPRESS_HELP)
+		def set_thumbnail_cache_size(option, opt_str, value, parser):
+			value = int(value)
+			if value < 0:
+				raise optparse.OptionValueError("Thumbnail cache size should "
+						"be zero or a positive integer")
+			parser.values.thumbnail_cache_size = value
+		parser.add_option("--thumbnail-cache-size", type="int", metavar="MB",
+				action="callback", callback=set_thumbnail_cache_size,
+				default=default_options["thumbnail_cache_size"],
+				help="Disk space in megabytes for resized album art kept in "
+						"the cache directory, so album art seen before needn't "
+						"be decoded again (default: %default, use 0 to "
+						"disable)")
+		def set_image_cache_size(option, opt_str, value, parser):
+			value = int(value)
+			if value < 0:
+				raise optparse.OptionValueError("Image cache size should be "
+						"zero or a positive integer")
+			parser.values.image_cache_size = value
+		parser.add_option("--image-cache-size", type="int", metavar="MB",
+				action="callback", callback=set_image_cache_size,
+				default=default_options["image_cache_size"],
+				help="Memory in megabytes for decoded album art, so resizing "
+						"the status icon or replaying an album needn't read "
+						"the image again (default: %default, use 0 to "
+						"disable)")
+		parser.add_option("--notification-quality", type="choice",
+				choices=("fast", "best"),
+				default=default_options["notification_quality"],
+				help="How album art is scaled for notifications: \"fast\" "
+						"decodes large JPEGs at reduced resolution and halves "
+						"large images cheaply before the final resample, "
+						"\"best\" resamples the full image (default: "
+						"%default)")
+		parser.add_option("--status-icon-quality", type="choice",
+				choices=("fast", "best"),
+				default=default_options["status_icon_quality"],
+				help="How album art is scaled for the status icon, as for "
+						"--notification-quality (default: %default)")
+		def set_image_threads(option, opt_str, value, parser):
+			value = int(value)
+			if value < 0:
+				raise optparse.OptionValueError("Image threads should be zero "
+						"or a positive integer")
+			parser.values.image_threads = value
+		parser.add_option("--image-threads", type="int", metavar="COUNT",
+				action="callback", callback=set_image_threads,
+				default=default_options["image_threads"],
+				help="Number of threads finding and scaling album art, so it "
+						"doesn't hold up the status icon or MPD (default: "
+						"%default, use 0 to do it in the main thread)")
+		def set_coalesce(option, opt_str, value, parser):
+			value = int(value)
+			if value < 0:
+				raise optparse.OptionValueError("Coalescing window should be "
+						"zero or a positive integer")
+			parser.values.coalesce = value
+		parser.add_option("--coalesce", type="int", metavar="MS",
+				action="callback", callback=set_coalesce,
+				default=default_options["coalesce"],
+				help="When songs change within this many milliseconds of each "
+						"other, as when skipping through the queue, only "
+						"update and show the notification for the last "
+						"(default: %default, use 0 to show every song)")
+		parser.add_option("--prefetch", action="store_true",
+				default=default_options["prefetch"],
+				help="Prepare the next song's album art in advance, so it's "
+						"ready as soon as the song starts %s" % d("prefetch"))
+		parser.add_option("--no-prefetch", dest="prefetch",
+				action="store_false", help=optparse.SUPPRESS_HELP)
+		def set_idle_subsystems(option, opt_str, value, parser):
+			parser.values.idle_subsystems = [v.strip()
+					for v in value.split(",") if v.strip()]
+		parser.add_option("--idle-subsystems", type="string",
+				metavar="LIST", action="callback",
+				callback=set_idle_subsystems,
+				default=default_options["idle_subsystems"],
+				help="Comma-separated MPD subsystems to watch as well as "
+						"player; only what a changed subsystem affects is "
+						"queried (default: %s)"
+						% ",".join(default_options["idle_subsystems"]))
 		parser.add_option("--status-icon", action="store_true", 
 				default=default_options["status_icon"],
 				help="Enable status icon %s" % d("status_icon"))
@@ -1075,6 +4206,14 @@ class Application:
 						"%f base filename / "
 						"%n track number / "
 						"%p playlist position / "
+						"%{tag} any other tag, such as %{date} / "
+						"%{server} server name / "
+						"%{elapsed} %{remaining} %{progress} playback "
+						"position, kept up to date while a notification with "
+						"no timeout is shown / "
+						"%{tag|other} first non-empty of several tags / "
+						"%[ %] section left out if its wildcards are empty / "
+						"%% percent sign / "
 						"<i> </i> italic text / "
 						"<b> </b> bold text / "
 						"<br> line break")
@@ -1086,17 +4225,73 @@ class Application:
 				help="Format for the notification body (default %default)")
 		parser.add_option_group(group)
 
+		parser.add_option("--server", metavar="NAME",
+				help="Of the servers in the configuration file's servers "
+						"setting, only watch the one with this name (or "
+						"host:port if it has no name); with --once the first "
+						"is used if this isn't given")
+
+		# options only settable from the configuration file
+		parser.set_defaults(cover_names=default_options["cover_names"],
+				servers=default_options["servers"])
+
 		# parse the commandline
 		(options, args) = parser.parse_args()
 
 		if len(args):
-			optionparser.error("Expected no non-option arguments")
+			parser.error("Expected no non-option arguments")
 
 		# dump default options if requested
 		if options.show_defaults:
 			print yaml.dump(DEFAULT_OPTIONS, default_flow_style=False)
 			sys.exit()
 
+		# ask a running MPN for its metrics if requested
+		if options.stats:
+			try:
+				sys.stdout.write(control_request(["stats", options.stats]))
+			except socket.error, e:
+				print >>sys.stderr, "Failed to reach a running MPN: %s" % e
+				sys.exit(1)
+			sys.exit()
+
+		# check the servers
+		if options.servers:
+			try:
+				check_servers(options.servers)
+			except ValueError, e:
+				parser.error("Invalid servers setting: %s" % e)
+
+		# check the formats, including any for particular servers
+		formats = [(name, getattr(options, name))
+				for name in ("title_format", "body_format")]
+		for server in options.servers or []:
+			formats.extend((name, server[name])
+					for name in ("title_format", "body_format")
+					if name in server)
+		for name, format in formats:
+			try:
+				Template(format)
+			except ValueError, e:
+				parser.error("Invalid %s setting: %s" % (name, e))
+
+		# check the idle subsystems, including any for particular servers
+		subsystems = [options.idle_subsystems]
+		subsystems.extend(server["idle_subsystems"]
+				for server in options.servers or []
+				if "idle_subsystems" in server)
+		for value in subsystems:
+			try:
+				check_idle_subsystems(value)
+			except ValueError, e:
+				parser.error("Invalid idle_subsystems setting: %s" % e)
+
+		# check the cover name rules
+		try:
+			CoverMatcher(options.cover_names)
+		except ValueError, e:
+			parser.error("Invalid cover_names setting: %s" % e)
+
 		# initialize the notifier
 		if not notify2.init("mpn", "glib"):
 			print "Failed to initialize notify2 module"
@@ -1108,7 +4303,28 @@ class Application:
 		signal.signal(signal.SIGINT, handle_exit_signal)
 		signal.signal(signal.SIGTERM, handle_exit_signal)
 
-		mpn = Notifier(options=options)
+		resources = Resources(options, default_options)
+		if not options.servers:
+			mpn = Notifier(options=options, resources=resources)
+		else:
+			servers = options.servers
+			if options.server is not None:
+				servers = [server for server in servers
+						if server_name(server) == options.server]
+				if not servers:
+					parser.error("No server named %s in the servers setting"
+							% options.server)
+			elif options.once:
+				# a notification from each would be confusing
+				servers = servers[:1]
+			for server in servers:
+				server_options = copy.copy(options)
+				for key in SERVER_OPTIONS:
+					if key in server:
+						setattr(server_options, key, server[key])
+				Notifier(options=server_options, resources=resources,
+						server=server)
+			mpn = resources.notifiers[0]
 
 		# fork if necessary
 		if options.daemon and not options.debug:
@@ -1121,6 +4337,61 @@ class Application:
 		except KeyboardInterrupt:
 			mpn.quit()
 
+# servers
+# ------------------------------------------------------------------------------
+
+# options which can be set for particular servers in the servers setting
+SERVER_OPTIONS = (
+	"title_format",
+	"body_format",
+	"timeout",
+	"keys",
+	"status_icon",
+	"play_state_icon_size",
+	"idle_subsystems",
+	"prefetch",
+	"coalesce",
+	)
+
+def server_name(server):
+	"""Return the name of a server from the servers setting"""
+	if "name" in server:
+		return server["name"]
+	return "%s:%s" % (server.get("host", "localhost"), server.get("port", 6600))
+
+def check_servers(servers):
+	"""Raise ValueError if the servers setting is malformed"""
+	if not isinstance(servers, list):
+		raise ValueError("expected a list of servers")
+	names = set()
+	for server in servers:
+		if not isinstance(server, dict):
+			raise ValueError("server %r is not a mapping" % (server,))
+		unknown = set(server) - set(("name", "host", "port", "password")) \
+				- set(SERVER_OPTIONS)
+		if unknown:
+			raise ValueError("unknown keys for server %s: %s"
+					% (server_name(server), ", ".join(sorted(unknown))))
+		name = server_name(server)
+		if name in names:
+			raise ValueError("more than one server is called %s" % name)
+		names.add(name)
+
+# MPD's idle subsystems
+IDLE_SUBSYSTEMS = ("database", "update", "stored_playlist", "playlist",
+		"player", "mixer", "output", "options", "partition", "sticker",
+		"subscription", "message", "neighbor", "mount")
+
+def check_idle_subsystems(subsystems):
+	"""Raise ValueError if an idle_subsystems setting is malformed"""
+	if not isinstance(subsystems, list) \
+			or not all(isinstance(s, basestring) for s in subsystems):
+		raise ValueError("expected a list of subsystem names")
+	unknown = set(subsystems) - set(IDLE_SUBSYSTEMS)
+	if unknown:
+		raise ValueError("unknown subsystems %s (known are %s)"
+				% (", ".join(sorted(unknown)), ", ".join(IDLE_SUBSYSTEMS)))
+
 # defaults
 # ------------------------------------------------------------------------------
 
@@ -1137,8 +4408,47 @@ DEFAULT_OPTIONS = {
 	"body_format": "<b>%b</b><br><i>%a</i>",
 	"status_icon": True,
 	"play_state_icon_size": 0.4,
+	"cover_names": list(possible_cover_filenames()),
+	"cover_parent_depth": 0,
+	"cover_index": True,
+	"cover_deadline": 2000,
+	"missing_cover_ttl": 600,
+	"embedded_covers": True,
+	"remote_covers": True,
+	"thumbnail_cache_size": 32,
+	"image_cache_size": 8,
+	"notification_quality": "fast",
+	"status_icon_quality": "fast",
+	"image_threads": 1,
+	"prefetch": False,
+	"idle_subsystems": ["playlist", "options", "database", "update"],
+	"servers": [],
+	"connect_timeout": 10,
+	"coalesce": 200,
 	}
 
+# options which "mpn ctl reload-config" can change without a restart
+RELOADABLE = (
+	"title_format",
+	"body_format",
+	"timeout",
+	)
+
+def load_config():
+	"""Return the default options updated with those in the configuration 
+	file, ~/.mpnrc or failing that mpnrc in the working directory"""
+	options = {}
+	options.update(DEFAULT_OPTIONS)
+	for path in (os.path.expanduser("~/.mpnrc"), "mpnrc"):
+		try:
+			stream = file(path, "r")
+		except IOError:
+			continue
+		options.update(yaml.load(stream))
+		stream.close()
+		break
+	return options
+
 # run if called directly
 # ------------------------------------------------------------------------------
 
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Thin client for the control socket of a running MPN, used by "mpn ctl". It
+imports nothing beyond the standard library's basics, so a keyboard shortcut
+running it takes a few milliseconds rather than loading GTK and connecting to
+MPD again.
+"""
+
+import os
+import sys
+import socket
+
+USAGE = """Usage: mpn ctl COMMAND [ARGUMENT...]
+
+Send a command to the running MPN. Commands:
+  show [SERVER]          show the notification for the current song
+  play [SERVER]          start playing
+  pause [SERVER]         pause
+  toggle [SERVER]        pause if playing, otherwise play
+  stop [SERVER]          stop playing
+  next [SERVER]          skip to the next song
+  prev [SERVER]          go back to the previous song
+  reconnect [SERVER]     retry connecting to MPD now
+  notify TEXT...         show a one-off notification
+  stats [text|json]      print metrics
+  reload-config          reread the formats and timeout from the configuration
+                         file
+
+SERVER is a server's name from the servers setting; without it every server is
+affected.
+"""
+
+def control_socket_path():
+	"""Return the path of the Unix socket a running MPN listens on"""
+	directory = os.environ.get("XDG_RUNTIME_DIR")
+	if not directory or not os.path.isdir(directory):
+		directory = os.path.join(os.environ.get("XDG_CACHE_HOME",
+				os.path.expanduser("~/.cache")), "mpn")
+	return os.path.join(directory, "mpn.sock")
+
+# seconds to wait for a running MPN to answer
+TIMEOUT = 10
+
+def control_request(words, path=None):
+	"""Send a command to a running MPN and return its reply. Raises
+	socket.error if there's no running MPN or it doesn't answer."""
+	client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+	client.settimeout(TIMEOUT)
+	try:
+		client.connect(path or control_socket_path())
+		client.sendall(" ".join(words) + "\n")
+		client.shutdown(socket.SHUT_WR)
+		chunks = []
+		while True:
+			chunk = client.recv(65536)
+			if not chunk:
+				break
+			chunks.append(chunk)
+		return "".join(chunks)
+	finally:
+		client.close()
+
+def main(words):
+	"""Run "mpn ctl" with the given arguments, return the exit status"""
+	if not words or words[0] in ("help", "-h", "--help"):
+		sys.stdout.write(USAGE)
+		return 0 if words else 2
+	try:
+		reply = control_request(words)
+	except socket.error, e:
+		sys.stderr.write("Failed to reach a running MPN: %s\n" % e)
+		return 1
+	if reply.startswith("error: "):
+		sys.stderr.write(reply)
+		return 1
+	if reply != "ok\n":
+		sys.stdout.write(reply)
+	return 0
@@ -16,7 +16,7 @@ setup(
 		url=mpn.URL,
 		license=mpn.LICENSE,
 
-		py_modules=["mpn"],
+		py_modules=["mpn", "mpnctl"],
 		scripts=["mpn"],
 		classifiers=[
 				"Intended Audience :: End Users/Desktop",